@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+#
+# Benchmark suite of the metric and simulation hot paths. Synthetic volumes and masks are generated for increasing
+# sizes, from the cropped phantom (36x24x10) up to the full PAM50 template and high-resolution cohorts, and the main()
+# of each script is timed in-process.
+#
+# USAGE:
+#   python benchmarks/benchmark.py run -o baseline.json [--sizes phantom pam50 highres] [--repeat 3]
+#   python benchmarks/benchmark.py compare baseline.json new.json [--threshold 0.2]
+#   python benchmarks/benchmark.py startup [--repeat 5]
+#
+# OUTPUT:
+#   run: JSON file with the timings of each case (in seconds), along with the environment they were measured in.
+#   compare: table of the ratio new/baseline for each case. Cases slower than the baseline by more than the threshold
+#   are flagged as regressions, and the script exits with status 1. Cases that could not run (e.g. missing plotting
+#   libraries) are listed as skipped in the JSON file, and are not compared.
+#   startup: cold-start time of each console entry point (with --help), and the plotting libraries it loads. Exits with
+#   status 1 if an entry point exceeds the time budget, or if it loads a plotting library at start-up.
+
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import redirect_stdout, redirect_stderr
+
+import nibabel
+import numpy as np
+
+from gmchallenge import compute_cnr
+
+
+# Shape of the synthetic volumes. "phantom" is the output of simu_create_phantom, "pam50" the PAM50 template from which
+# phantoms are generated, and "highres" a high in-plane resolution acquisition.
+SIZES = OrderedDict([
+    ('phantom', (36, 24, 10)),
+    ('pam50', (141, 141, 1100)),
+    ('highres', (448, 448, 60)),
+])
+
+# Cold-start time budget of the console entry points, in seconds
+STARTUP_BUDGET = 0.5
+# Entry points are not allowed to load these modules at start-up
+PLOTTING_MODULES = ['matplotlib', 'seaborn', 'ptitprince']
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Benchmark the metric and simulation hot paths.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_run = subparsers.add_parser('run', help='Run the benchmarks and write their timings in a JSON file.')
+    parser_run.add_argument("-o", "--output",
+                            help="JSON output file. Default=benchmark.json.",
+                            default='benchmark.json')
+    parser_run.add_argument("--sizes",
+                            help=f"Sizes of the synthetic data. Default={' '.join(SIZES)}.",
+                            nargs='+',
+                            choices=list(SIZES),
+                            default=list(SIZES))
+    parser_run.add_argument("--repeat",
+                            help="Number of times each case is run. Default=3.",
+                            type=int,
+                            default=3)
+    parser_run.add_argument("--cohort",
+                            help="Number of subjects of the synthetic cohort processed with compute_cnr --batch. "
+                                 "Default=4.",
+                            type=int,
+                            default=4)
+    parser_compare = subparsers.add_parser('compare', help='Compare the timings of two runs and flag regressions.')
+    parser_compare.add_argument("baseline", help="JSON file of the reference run.")
+    parser_compare.add_argument("new", help="JSON file of the run to check.")
+    parser_compare.add_argument("--threshold",
+                                help="Relative slow-down above which a case is flagged as a regression. "
+                                     "Default=0.2.",
+                                type=float,
+                                default=0.2)
+    parser_startup = subparsers.add_parser('startup', help='Check the cold-start time of each console entry point '
+                                                           'against its budget.')
+    parser_startup.add_argument("--repeat",
+                                help="Number of times each entry point is started. Default=5.",
+                                type=int,
+                                default=5)
+    return parser
+
+
+def get_entry_points():
+    """
+    Return the console entry points declared in setup.py.
+    Returns:
+        dict: {name: module}
+    """
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'setup.py')) as f:
+        return dict(re.findall(r"'(\w+)=([\w.]+):main'", f.read()))
+
+
+def measure_startup(module, repeat):
+    """
+    Start a fresh interpreter that runs the main() of module with --help, as the console entry point does.
+    Returns:
+        times: list of the wall time of each start, in seconds
+        modules: plotting modules that were loaded
+    """
+    code = (f"import sys\n"
+            f"from {module} import main\n"
+            f"try:\n"
+            f"    main(['--help'])\n"
+            f"except SystemExit:\n"
+            f"    pass\n"
+            f"print(' '.join(sorted(m for m in sys.modules if m.split('.')[0] in {PLOTTING_MODULES!r})))\n")
+    times = []
+    for _ in range(repeat):
+        time_start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+        times.append(time.perf_counter() - time_start)
+    return times, output.splitlines()[-1].split() if output.strip() else []
+
+
+def check_startup(repeat):
+    """
+    Check the cold-start time of each entry point against its budget, and that none of them loads plotting libraries
+    at start-up.
+    Returns:
+        list of the entry points that failed the check
+    """
+    failed = []
+    print(f"{'Entry point':40s} {'Time (s)':>10s} {'Budget (s)':>10s}")
+    for name, module in get_entry_points().items():
+        times, modules = measure_startup(module, repeat)
+        flag = ''
+        if min(times) > STARTUP_BUDGET:
+            flag += '  OVER BUDGET'
+        if modules:
+            flag += f"  LOADS {' '.join(sorted(set(m.split('.')[0] for m in modules)))}"
+        if flag:
+            failed.append(name)
+        print(f"{name:40s} {min(times):10.3f} {STARTUP_BUDGET:10.3f}{flag}")
+    return failed
+
+
+def generate_atlas(shape):
+    """
+    Generate probabilistic atlases of the WM and the GM, with the size of the PAM50 cord (about 30x20 voxels) in the
+    center of each axial slice. The cord is scaled up with the in-plane matrix size for high-resolution shapes. Edges
+    are linear ramps over about one voxel, to mimic partial volume.
+    Returns:
+        data_wm, data_gm: 3d float64 arrays with values in [0, 1]
+    """
+    nx, ny, nz = shape
+    scale = max(1, min(nx, ny) / SIZES['pam50'][0])
+    x, y = np.meshgrid(np.arange(nx) - nx / 2, np.arange(ny) - ny / 2, indexing='ij')
+
+    def ellipse(a, b):
+        radius = np.sqrt((x / a) ** 2 + (y / b) ** 2)
+        return np.clip(b * (1 - radius) + 0.5, 0, 1)
+
+    cord = ellipse(15 * scale, 10 * scale)
+    data_gm = ellipse(7 * scale, 4 * scale)
+    data_wm = cord - data_gm
+    return [np.repeat(data[..., np.newaxis], nz, axis=2) for data in [data_wm, data_gm]]
+
+
+def generate_subject(path_out, shape, rng):
+    """
+    Generate the input files of compute_cnr for one subject: two float32 scans, the WM and GM masks (thresholded atlas,
+    like simu_create_phantom) and the JSON sidecar.
+    Returns:
+        dict of file names, with the keys of the manifest of compute_cnr --batch
+    """
+    os.makedirs(path_out, exist_ok=True)
+    data_wm, data_gm = generate_atlas(shape)
+    fnames = {'json': os.path.join(path_out, 'data1.json')}
+    for name in ['data1', 'data2']:
+        data = (100 * data_wm + 140 * data_gm + rng.normal(0, 5, shape)).astype(np.float32)
+        fnames[name] = os.path.join(path_out, name + '.nii.gz')
+        nibabel.save(nibabel.Nifti1Image(data, np.eye(4)), fnames[name])
+    for name, data in [('mask-wm', data_wm), ('mask-gm', data_gm)]:
+        fnames[name] = os.path.join(path_out, name.replace('-', '_') + '.nii.gz')
+        nibabel.save(nibabel.Nifti1Image((data >= 0.9).astype(np.uint8), np.eye(4)), fnames[name])
+    fnames['mask-noise'] = fnames['mask-wm']
+    with open(fnames['json'], 'w') as f:
+        json.dump({'AcquisitionDuration': 240}, f)
+    return fnames
+
+
+def generate_sct_dir(path_out):
+    """
+    Generate a fake SCT installation with PAM50-sized WM and GM atlases, for simu_create_phantom.
+    Returns:
+        path of the fake SCT_DIR
+    """
+    folder_template = os.path.join(path_out, 'data', 'PAM50', 'template')
+    os.makedirs(folder_template, exist_ok=True)
+    for name, data in zip(['wm', 'gm'], generate_atlas(SIZES['pam50'])):
+        nibabel.save(nibabel.Nifti1Image(data.astype(np.float32), np.eye(4)),
+                     os.path.join(folder_template, f'PAM50_{name}.nii.gz'))
+    return path_out
+
+
+def generate_spinegeneric(path_out, n_subjects, rng):
+    """
+    Generate the results and participants files of a synthetic spine-generic cohort, for generate_figure_spinegeneric.
+    Returns:
+        fname_results, fname_participants
+    """
+    os.makedirs(path_out, exist_ok=True)
+    subjects = [f'sub-{i:04d}' for i in range(n_subjects)]
+    fname_results = os.path.join(path_out, 'results.csv')
+    with open(fname_results, 'w') as f:
+        f.write('Subject,' + ','.join(compute_cnr.CSV_COLUMNS) + '\n')
+        for subject in subjects:
+            snr, contrast, cnr = rng.normal(20, 4), rng.normal(25, 5), rng.normal(6, 1)
+            f.write(f'{subject},{snr},,{contrast},{cnr},,{cnr / 15},\n')
+    fname_participants = os.path.join(path_out, 'participants.tsv')
+    with open(fname_participants, 'w') as f:
+        f.write('participant_id\tmanufacturer\n')
+        for subject in subjects:
+            f.write(f"{subject}\t{rng.choice(['Philips', 'Siemens', 'GE'])}\n")
+    return fname_results, fname_participants
+
+
+def time_case(func, repeat, setup=None):
+    """
+    Run func() repeat times and return its timings in seconds. setup() is called before each run, and is not timed.
+    The outputs of func() are discarded.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), redirect_stderr(devnull):
+            time_start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - time_start)
+    return times
+
+
+def get_environment():
+    """Return the description of the environment the benchmarks are run in, to check that runs are comparable."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'nibabel': nibabel.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()}
+
+
+def get_cases(path_tmp, sizes, cohort):
+    """
+    Generate the synthetic data and return the benchmark cases.
+    Returns:
+        list of tuples: (name, func, setup). func raises ImportError if optional dependencies are missing.
+    """
+    from gmchallenge import simu_create_phantom, simu_monte_carlo, simu_process_data
+
+    rng = np.random.default_rng(0)
+    cases = []
+    for name, module in get_entry_points().items():
+        cases.append((f'startup[{name}]', lambda module=module: measure_startup(module, 1), None))
+    for size in sizes:
+        shape = SIZES[size]
+        path_size = os.path.join(path_tmp, size)
+        fnames = generate_subject(os.path.join(path_size, 'sub-00'), shape, rng)
+        argv = ['--data1', fnames['data1'], '--data2', fnames['data2'], '--mask-noise', fnames['mask-noise'],
+                '--mask-wm', fnames['mask-wm'], '--mask-gm', fnames['mask-gm'], '--json', fnames['json']]
+        cases.append((f'compute_cnr[{size}]', lambda argv=argv: compute_cnr.main(argv),
+                      compute_cnr.volume_cache.clear))
+        # Cohort of subjects processed in batch
+        fname_manifest = os.path.join(path_size, 'manifest.csv')
+        with open(fname_manifest, 'w') as f:
+            columns = ['data1', 'data2', 'mask-noise', 'mask-wm', 'mask-gm', 'json']
+            f.write('subject,' + ','.join(columns) + '\n')
+            for i_subject in range(cohort):
+                fnames = generate_subject(os.path.join(path_size, f'sub-{i_subject:02d}'), shape, rng)
+                f.write(f'sub-{i_subject:02d},' + ','.join(fnames[column] for column in columns) + '\n')
+        argv = ['--batch', fname_manifest, '--output', os.path.join(path_size, 'results.csv')]
+        cases.append((f'compute_cnr_batch[{size}]', lambda argv=argv: compute_cnr.main(argv),
+                      compute_cnr.volume_cache.clear))
+
+    # Simulations are generated from the PAM50 template, whatever the size of the synthetic data above
+    path_simu = os.path.join(path_tmp, 'simu')
+    os.makedirs(path_simu, exist_ok=True)
+    os.environ['SCT_DIR'] = generate_sct_dir(os.path.join(path_tmp, 'sct'))
+    folders_phantom = [os.path.join(path_simu, folder) for folder in ['phantom1', 'phantom2']]
+
+    def create_phantoms():
+        for folder in folders_phantom:
+            simu_create_phantom.main(['-o', folder])
+
+    def process_data():
+        # simu_process_data and simu_make_figures write in the current directory
+        os.chdir(path_simu)
+        if not os.path.isdir(folders_phantom[0]):
+            create_phantoms()
+        simu_process_data.main(['-i'] + folders_phantom)
+
+    def reset_process_data():
+        # simu_process_data reuses the results of previous runs: remove them, so that each repeat processes all pairs
+        compute_cnr.volume_cache.clear()
+        shutil.rmtree(os.path.join(path_simu, 'simu_results'), ignore_errors=True)
+
+    def make_figures():
+        # Figure scripts are imported when run, since plotting libraries are optional
+        from gmchallenge import simu_make_figures
+        os.chdir(path_simu)
+        simu_make_figures.main(['-i', os.path.join('simu_results', 'results_all.csv'), '-s', '0'])
+
+    def monte_carlo():
+        simu_monte_carlo.main(['-n', '1000', '--seed', '0', '-o', os.path.join(path_simu, 'results_montecarlo.csv')])
+
+    cases += [('simu_create_phantom[pam50]', create_phantoms, None),
+              ('simu_monte_carlo[pam50]', monte_carlo, None),
+              ('simu_process_data[pam50]', process_data, reset_process_data),
+              ('simu_make_figures', make_figures, None)]
+
+    # Size of the spine-generic multi-subject dataset
+    fname_results, fname_participants = generate_spinegeneric(os.path.join(path_tmp, 'spinegeneric'), 300, rng)
+
+    def make_figures_spinegeneric():
+        from gmchallenge import generate_figure_spinegeneric
+        generate_figure_spinegeneric.main(['-ir', fname_results, '-ip', fname_participants,
+                                           '-o', os.path.join(path_tmp, 'spinegeneric', 'fig')])
+
+    cases.append(('generate_figure_spinegeneric', make_figures_spinegeneric, None))
+    return cases
+
+
+def run(fname_out, sizes, repeat, cohort):
+    """Run all the benchmark cases, and write their timings in fname_out."""
+    results = OrderedDict()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as path_tmp:
+        for name, func, setup in get_cases(path_tmp, sizes, cohort):
+            try:
+                times = time_case(func, repeat, setup)
+                results[name] = {'times': times, 'min': min(times), 'median': float(np.median(times))}
+                print(f"{name}: {results[name]['min']:.3f} s")
+            except ImportError as e:
+                # Plotting libraries are optional
+                results[name] = {'skipped': str(e)}
+                print(f"{name}: skipped ({e})")
+            except Exception as e:
+                # Do not lose the timings of the other cases
+                results[name] = {'skipped': f"{type(e).__name__}: {e}"}
+                print(f"{name}: failed ({type(e).__name__}: {e})")
+            finally:
+                os.chdir(cwd)
+    with open(fname_out, 'w') as f:
+        json.dump({'environment': get_environment(), 'sizes': {size: SIZES[size] for size in sizes},
+                   'repeat': repeat, 'cohort': cohort, 'results': results}, f, indent=2)
+
+
+def compare(fname_baseline, fname_new, threshold):
+    """
+    Compare the minimum timing of each case between two runs.
+    Returns:
+        list of the names of the cases that regressed
+    """
+    runs = []
+    for fname in [fname_baseline, fname_new]:
+        with open(fname) as f:
+            runs.append(json.load(f))
+    baseline, new = runs
+    for key in ['python', 'numpy', 'platform', 'cpu_count']:
+        if baseline['environment'][key] != new['environment'][key]:
+            print(f"Warning: {key} differs between runs: {baseline['environment'][key]} vs. "
+                  f"{new['environment'][key]}")
+    regressions = []
+    print(f"{'Case':40s} {'Baseline (s)':>12s} {'New (s)':>12s} {'Ratio':>8s}")
+    for name, result_baseline in baseline['results'].items():
+        result_new = new['results'].get(name)
+        if result_new is None or 'skipped' in result_baseline or 'skipped' in result_new:
+            print(f"{name:40s} {'-':>12s} {'-':>12s} {'n/a':>8s}")
+            continue
+        ratio = result_new['min'] / result_baseline['min']
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:40s} {result_baseline['min']:12.3f} {result_new['min']:12.3f} {ratio:8.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run(args.output, args.sizes, args.repeat, args.cohort)
+    elif args.command == 'startup':
+        if check_startup(args.repeat):
+            sys.exit(1)
+    else:
+        if compare(args.baseline, args.new, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
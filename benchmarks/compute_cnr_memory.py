@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#
+# Compare the peak memory (RSS) of compute_cnr when inputs are loaded as float64 arrays with get_fdata() (previous
+# behaviour) vs. with compute_cnr.load_data() (memory-mapped, dtype-preserving) vs. streamed by z-slabs.
+#
+# USAGE:
+#   python benchmarks/compute_cnr_memory.py [-s 320 320 60]
+#
+# OUTPUT:
+#   Peak RSS of each method, in MB. Each method runs in a fresh process.
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+
+import nibabel
+import numpy as np
+
+from gmchallenge import compute_cnr, utils
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Compare the peak memory of compute_cnr across loading methods.')
+    parser.add_argument("-s", "--shape",
+                        help="Shape of the synthetic volumes. Default=320 320 60.",
+                        type=int,
+                        nargs=3,
+                        default=[320, 320, 60])
+    return parser
+
+
+def generate_data(path_out, shape):
+    """Generate two float32 volumes, stored uncompressed, and uint8 masks in the center of the FOV."""
+    rng = np.random.default_rng(0)
+    nx, ny, _ = shape
+    mask_wm = np.zeros(shape, dtype=np.uint8)
+    mask_wm[nx // 2 - 10:nx // 2 + 10, ny // 2 - 8:ny // 2 + 8, :] = 1
+    mask_gm = np.zeros(shape, dtype=np.uint8)
+    mask_gm[nx // 2 - 4:nx // 2 + 4, ny // 2 - 3:ny // 2 + 3, :] = 1
+    mask_wm[mask_gm > 0] = 0
+    fnames = {}
+    for name in ['data1', 'data2']:
+        data = (100 * mask_wm + 140 * mask_gm + rng.normal(0, 5, shape)).astype(np.float32)
+        fnames[name] = os.path.join(path_out, name + '.nii')
+        nibabel.save(nibabel.Nifti1Image(data, np.eye(4)), fnames[name])
+    for name, mask in [('mask_wm', mask_wm), ('mask_gm', mask_gm)]:
+        fnames[name] = os.path.join(path_out, name + '.nii.gz')
+        nibabel.save(nibabel.Nifti1Image(mask, np.eye(4)), fnames[name])
+    return fnames
+
+
+def run(fnames, method, queue):
+    """Compute metrics with the specified loading method, and return the peak RSS in MB through the queue."""
+    if method == 'get_fdata':
+        inputs = {name: nibabel.load(fname).get_fdata() for name, fname in fnames.items()}
+    else:
+        inputs = fnames
+    compute_cnr.compute_metrics(inputs['data1'], inputs['mask_wm'], inputs['mask_wm'], inputs['mask_gm'],
+                                data2=inputs['data2'], slab_size=8 if method == 'slab' else None)
+    queue.put(utils.get_maxrss_mb())
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as path_tmp:
+        fnames = generate_data(path_tmp, args.shape)
+        print(f"Shape: {args.shape}")
+        for method in ['get_fdata', 'load_data', 'slab']:
+            queue = ctx.Queue()
+            process = ctx.Process(target=run, args=(fnames, method, queue))
+            process.start()
+            peak_rss = queue.get()
+            process.join()
+            print(f"{method}: peak RSS = {peak_rss:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,161 @@
 #!/usr/bin/env python
 # Compute SNR, contrast, CNR and CNR/unit time. Write output  Output values in stdout.
 # Author: Julien Cohen-Adad
+#
+# The hash of this file versions the cached metrics (see simu_process_data.hash_pairs() and pipeline.get_stages()), so
+# it only holds the code of the metrics and the command line. Batch mode and shards are in compute_cnr_batch.py, the
+# server in compute_cnr_server.py and general-purpose helpers in utils.py.
 
 # TODO: use logging
 
 import argparse
 import json
 import os.path
-import nibabel
+import sys
+from dataclasses import dataclass
+from typing import List, Optional
+
 import numpy as np
 
+from gmchallenge.compute_cnr_client import DEFAULT_SOCKET
+from gmchallenge.utils import Profiler, VolumeCache, get_cache_bytes, profile_stage, write_atomic
+
+
+# Column names of the CSV output, in the same order as the fields of Results
+CSV_COLUMNS = ['SNR_single', 'SNR_diff', 'Contrast', 'CNR_single', 'CNR_diff', 'CNR_single/t', 'CNR_diff/t']
+
+
+@dataclass
+class Results:
+    """
+    Metrics returned by compute_metrics(). Metrics that could not be computed are set to None. For 4d (multi-echo)
+    inputs, metrics are computed on the root-mean-square across echoes, and the metrics of each echo can be listed
+    in echoes.
+    """
+    snr_single: float
+    snr_diff: Optional[float]
+    contrast: float
+    cnr_single: float
+    cnr_diff: Optional[float]
+    cnr_single_time: Optional[float]
+    cnr_diff_time: Optional[float]
+    echoes: Optional[List['Results']] = None
+
+    @property
+    def metrics(self):
+        """List of metrics, in the same order as CSV_COLUMNS"""
+        return [self.snr_single, self.snr_diff, self.contrast, self.cnr_single, self.cnr_diff, self.cnr_single_time,
+                self.cnr_diff_time]
+
+    def to_dict(self):
+        """Return results as a dictionary, with the keys used historically by compute_cnr.main()"""
+        results = dict(zip(['SNR_single', 'SNR_diff', 'Contrast', 'CNR_single', 'CNR_diff', 'CNR_single_time',
+                            'CNR_diff_time'], self.metrics))
+        if self.echoes is not None:
+            results['Echoes'] = [echo.to_dict() for echo in self.echoes]
+        return results
+
+    def to_csv_row(self, subject):
+        """Return results as a CSV line (without line return), preceded by the subject ID"""
+        values = ['' if value is None else str(value) for value in self.metrics]
+        return ','.join([subject] + values)
+
+    def to_csv_rows(self, subject):
+        """Return a list of CSV lines: one for the results, followed by one for each echo (as "<SUBJECT>_echo-<N>")"""
+        rows = [self.to_csv_row(subject)]
+        for i_echo, echo in enumerate(self.echoes or []):
+            rows.append(echo.to_csv_row(f"{subject}_echo-{i_echo + 1}"))
+        return rows
+
+
+@dataclass
+class MaskIndex:
+    """
+    Compact (CSR-style) index of the non-null voxels of a mask, sorted by z-slice: the voxels of slice iz are
+    flat_index[indptr[iz]:indptr[iz+1]], with mask values weights[indptr[iz]:indptr[iz+1]]. Statistics computed
+    through the index only gather the voxels within the mask, instead of scanning the full volume for each metric.
+    """
+    shape: tuple
+    flat_index: np.ndarray
+    indptr: np.ndarray
+    weights: np.ndarray
+
+    @classmethod
+    def from_mask(cls, mask, slab_size=None):
+        """
+        Build the index from a 3d array of weights. mask can also be a nibabel array proxy: it is then read by slabs of
+        slab_size z-slices, so that the full mask is never held in memory.
+        """
+        nz = mask.shape[2]
+        slab_size = slab_size or nz
+        flat_index, weights, count_slice = [], [], []
+        for z0 in range(0, nz, slab_size):
+            slab = np.asanyarray(mask[..., z0:z0 + slab_size])
+            # Move z to the first axis, so that np.nonzero returns voxels sorted by slice
+            z, x, y = np.nonzero(np.moveaxis(slab, 2, 0))
+            weights.append(np.asarray(slab[x, y, z], dtype=np.float64))
+            flat_index.append(np.ravel_multi_index((x, y, z + z0), mask.shape))
+            count_slice.append(np.bincount(z, minlength=slab.shape[2]))
+        indptr = np.concatenate([[0], np.cumsum(np.concatenate(count_slice))])
+        return cls(tuple(mask.shape), np.concatenate(flat_index), indptr, np.concatenate(weights))
+
+    @property
+    def coords(self):
+        """Tuple of (x, y, z) coordinates of the voxels"""
+        return np.unravel_index(self.flat_index, self.shape)
+
+    def crop(self, bbox):
+        """
+        Return the index within the bounding box bbox (see get_bounding_box()). Voxels outside the z-range of bbox are
+        dropped, while the (x, y) range of bbox must include all voxels.
+        """
+        start = [s.indices(n)[0] for s, n in zip(bbox, self.shape)]
+        stop = [s.indices(n)[1] for s, n in zip(bbox, self.shape)]
+        shape = tuple(b - a for a, b in zip(start, stop))
+        # Voxels are sorted by slice, so the voxels within the z-range are contiguous
+        ind = slice(self.indptr[start[2]], self.indptr[stop[2]])
+        coords = tuple(c[ind] - a for c, a in zip(self.coords, start))
+        indptr = self.indptr[start[2]:stop[2] + 1] - self.indptr[start[2]]
+        return MaskIndex(shape, np.ravel_multi_index(coords, shape), indptr, self.weights[ind])
+
+    def gather(self, data):
+        """
+        Return the values of data (3d array with the same shape as the mask) at the voxels of the index. data can have
+        additional trailing axes (e.g. noise realizations), in which case the values have the same trailing axes.
+        """
+        return np.asarray(data[self.coords], dtype=np.float64)
+
+    def compute_stats(self, values):
+        """
+        Compute the weighted mean and standard deviation of the values gathered at the voxels of the index, for each
+        slice. Voxels are sorted by slice, so the sums over each slice are reductions over contiguous segments of
+        values. The variance is computed from the deviations to the mean of each slice (instead of the difference
+        between the mean of squares and the squared mean), which is numerically stable even for high SNR.
+        Args:
+            values: 1d array, see gather(). If values have trailing axes, statistics are computed independently along
+                    them, and have the same trailing axes.
+        Returns:
+            mean: 1d array of weighted means, for each z-slice where the mask is not null
+            std: 1d array of weighted standard deviations, for each z-slice where the mask is not null
+        """
+        count = np.diff(self.indptr)
+        start = self.indptr[:-1][count > 0]
+        if start.size == 0:
+            return np.zeros((0,) + values.shape[1:]), np.zeros((0,) + values.shape[1:])
+        weights = self.weights.reshape((-1,) + (1,) * (values.ndim - 1))
+        sum_w = np.add.reduceat(weights, start, axis=0)
+        # Only keep slices where the mask is not null
+        is_valid = sum_w.ravel() != 0
+        mean = np.add.reduceat(values * weights, start, axis=0) / np.where(sum_w != 0, sum_w, 1)
+        deviation = values - np.repeat(mean, count[count > 0], axis=0)
+        variance = np.add.reduceat(weights * deviation ** 2, start, axis=0)
+        return mean[is_valid], np.sqrt(variance[is_valid] / sum_w[is_valid])
+
+
+# Process-wide cache used by load_data(). The cap can be changed with the environment variable GMCHALLENGE_CACHE_MB
+# (see get_cache_bytes()), or by setting volume_cache.max_bytes.
+volume_cache = VolumeCache(max_bytes=get_cache_bytes())
+
 
 def get_parser():
     parser = argparse.ArgumentParser(description='Compute SNR, contrast, CNR using two different methods. These '
@@ -17,24 +163,56 @@ def get_parser():
                                                  'If a JSON sidecar is present and includes the field '
                                                  'AcquisitionDuration, this script will also compute CNR per unit '
                                                  'time.')
-    parser.add_argument('--data1', help='First volume')
+    parser.add_argument('--data1', help='First volume. If 4d (e.g. multi-echo), metrics are computed on the '
+                                        'root-mean-square across the 4th dimension.')
     parser.add_argument('--data2', help='Second volume (required for the "diff" method)', required=False)
     parser.add_argument('--mask-noise', help='Mask where to compute noise.')
     parser.add_argument('--mask-wm', help='Mask of the white matter.')
     parser.add_argument('--mask-gm', help='Mask of the gray matter.')
     parser.add_argument('--json', help='JSON sidecar to fetch acquisition duration.')
     parser.add_argument('--subject', help='Subject ID', default='sub')
-    parser.add_argument('--output', help='CSV output file.')
+    parser.add_argument('--output', help='CSV output file. The results of each subject are written in their own file '
+                                         'under "<OUTPUT>.shards/", so that parallel jobs never write to the same '
+                                         'file. Merge them into the output file with --merge once all jobs are '
+                                         'finished.')
+    parser.add_argument('--cache-mask-index', help='Save the index of the non-null voxels of each mask next to the '
+                                                   'mask file ("<MASK>.index.npz"), and reuse it in subsequent runs '
+                                                   'that share the same masks.', action='store_true')
+    parser.add_argument('--slab-size', help='Stream the volumes by slabs of this number of z-slices, instead of '
+                                            'loading them in memory. Use this for very large volumes: memory usage is '
+                                            'bounded by the size of a slab, and results are identical.', type=int)
+    parser.add_argument('--per-echo', help='For 4d inputs, also output the metrics of each echo, as additional rows '
+                                           'with subject "<SUBJECT>_echo-<N>".', action='store_true')
+    parser.add_argument('--batch', help='CSV manifest to process multiple subjects at once, with columns: subject, '
+                                        'data1, data2, mask-noise, mask-wm, mask-gm, json. The data2 and json '
+                                        'columns can be left empty or omitted. Relative paths are relative to the '
+                                        'manifest. Results of all subjects are written in a single pass to '
+                                        '--output, which is overwritten. When this flag is used, the other input '
+                                        'flags are ignored.')
+    parser.add_argument('--jobs', help='Number of parallel jobs for --batch and --serve. Set to -1 to use all the '
+                                       'available CPU cores.', type=int, default=1)
+    parser.add_argument('--serve', help='Start a server that listens to --socket and processes the requests sent by '
+                                        'compute_cnr_client with a pool of --jobs worker processes. Workers keep '
+                                        'their imports and caches warm across requests.', action='store_true')
+    parser.add_argument('--socket', help='Unix socket of the server.', default=DEFAULT_SOCKET)
+    parser.add_argument('--merge', help='Merge all per-subject results (and profiles) under "<OUTPUT>.shards/" into '
+                                        '--output, and exit. Run this once all jobs are finished.',
+                        action='store_true')
+    parser.add_argument('--profile', help='Record the wall time, CPU time and peak memory of each stage (loading, '
+                                          'statistics, CNR, output), and write them in a JSON file next to the '
+                                          'results: "<OUTPUT>.shards/<SUBJECT>.profile.json" (per-subject) and '
+                                          '"<OUTPUT>.profile.json" (aggregated across subjects). Without --output, '
+                                          'the profile is printed.', action='store_true')
     return parser
 
 
-def compute_cnr_time(data, mask_wm, mask_gm, noise_slice, fname_json):
+def compute_cnr_time_from_means(mean_wm_slice, mean_gm_slice, noise_slice, fname_json):
     """
-    Compute contrast, CNR and CNR per unit time
+    Compute contrast, CNR and CNR per unit time from the slice-wise mean in the WM and in the GM. Inputs can have
+    trailing axes (e.g. noise realizations): metrics are averaged across slices (first axis) only.
     Args:
-        data: 3d array to compute CNR from
-        mask_wm: mask of white matter
-        mask_gm: mask of gray matter
+        mean_wm_slice: mean in the white matter per slice
+        mean_gm_slice: mean in the gray matter per slice
         noise_slice: noise standard deviation per slice
         fname_json: file name of JSON file that contains the AcquisitionDuration information. If 'None', does not
                     compute cnr_time and output 'None' instead
@@ -44,15 +222,10 @@ def compute_cnr_time(data, mask_wm, mask_gm, noise_slice, fname_json):
         cnr
         cnr_time
     """
-    nx, ny, nz = data.shape
-    mean_wm_slice = \
-        [np.average(data[..., iz], weights=mask_wm[..., iz]) for iz in range(nz) if np.any(mask_wm[..., iz])]
-    mean_gm_slice = \
-        [np.average(data[..., iz], weights=mask_gm[..., iz]) for iz in range(nz) if np.any(mask_gm[..., iz])]
-    contrast_slice = [abs(mean_wm_slice[iz] - mean_gm_slice[iz]) / mean_wm_slice[iz] for iz in range(nz)]
-    contrast = 100 * sum(contrast_slice) / len(contrast_slice)
-    cnr_slice = [abs(mean_wm_slice[iz] - mean_gm_slice[iz]) / noise_slice[iz] for iz in range(nz)]
-    cnr = sum(cnr_slice) / len(cnr_slice)
+    contrast_slice = np.abs(mean_wm_slice - mean_gm_slice) / mean_wm_slice
+    contrast = 100 * np.mean(contrast_slice, axis=0)
+    cnr_slice = np.abs(mean_wm_slice - mean_gm_slice) / noise_slice
+    cnr = np.mean(cnr_slice, axis=0)
     # If no JSON file is provided, only return 'cnr'
     if fname_json is None:
         cnr_time = None
@@ -64,7 +237,7 @@ def compute_cnr_time(data, mask_wm, mask_gm, noise_slice, fname_json):
         except ReferenceError:
             print("Field 'AcquisitionDuration' was not found in the JSON sidecar. Cannot compute CNR per unit time and will"
                   "leave an empty string instead.")
-            cnr_time = ''
+            cnr_time = None
     return contrast, cnr, cnr_time
 
 
@@ -82,91 +255,381 @@ def fetch_acquisition_duration(fname_json):
             raise ReferenceError
 
 
-def weighted_std(values, weights):
+def compute_slice_stats(data, mask):
+    """
+    Compute the weighted mean and standard deviation of data within mask, for all z-slices at once. Only the voxels
+    within the mask are gathered (see MaskIndex.compute_stats()).
+    Args:
+        data: 3d array
+        mask: 3d array of weights, with the same shape as data, or MaskIndex
+    Returns:
+        mean: 1d array of weighted means, for each z-slice where the mask is not null
+        std: 1d array of weighted standard deviations, for each z-slice where the mask is not null
+    """
+    if not isinstance(mask, MaskIndex):
+        mask = MaskIndex.from_mask(mask)
+    return mask.compute_stats(mask.gather(data))
+
+
+def compute_diff_stats(data1, data2, mask_noise, mask_wm, mask_gm):
+    """
+    Compute the statistics required by the "diff" metrics: the mean of the average image (data1 + data2) / 2 in the
+    noise, WM and GM masks, and the noise STD of the difference image data2 - data1. data1 and data2 are only read at
+    the voxels of each mask, so that no full-volume copy of the mean or difference images is allocated.
+    Args:
+        data1: 3d array
+        data2: 3d array
+        mask_noise: mask where to compute noise (array or MaskIndex)
+        mask_wm: mask of white matter (array or MaskIndex)
+        mask_gm: mask of gray matter (array or MaskIndex)
+    Returns:
+        mean_noise_slice: mean of the average image in the noise mask, per slice
+        noise_diff_slice: STD of the difference image in the noise mask, divided by sqrt(2), per slice
+        mean_wm_slice: mean of the average image in the white matter, per slice
+        mean_gm_slice: mean of the average image in the gray matter, per slice
+    """
+    stats = []
+    for mask in [mask_noise, mask_wm, mask_gm]:
+        if not isinstance(mask, MaskIndex):
+            mask = MaskIndex.from_mask(mask)
+        values1, values2 = mask.gather(data1), mask.gather(data2)
+        mean_slice, _ = mask.compute_stats((values1 + values2) / 2)
+        if not stats:
+            # The "np.sqrt(2)" results from the variance of the subtraction of two distributions:
+            # var(A-B) = var(A) + var(B).
+            # More context in: https://github.com/spinalcordtoolbox/spinalcordtoolbox/issues/3481
+            _, noise_diff_slice = mask.compute_stats(values2 - values1)
+            stats += [mean_slice, noise_diff_slice / np.sqrt(2)]
+        else:
+            stats.append(mean_slice)
+    return tuple(stats)
+
+
+def load_data(data, bbox=None):
     """
-    Return the weighted average and standard deviation.
-    values, weights -- Numpy ndarrays with the same shape.
-    Source: https://stackoverflow.com/questions/2413522/weighted-standard-deviation-in-numpy
+    Return data as an array, while avoiding unnecessary copies and type conversions:
+    - Images that are stored without scaling are returned in their on-disk data type (e.g. uint8 or bool masks stay
+      uint8 or bool). Uncompressed .nii files are memory-mapped.
+    - Images with scaling factors are scaled to float32 (instead of float64 with get_fdata()). The relative precision
+      of float32 (~6e-8) is well below the noise of MRI data: metrics differ from a float64 computation by less than
+      1e-6 (relative), because values are converted to float64 when they are gathered (see MaskIndex.gather()).
+    - If bbox is provided, only the sub-volume within the bounding box is read from disk, through the nibabel array
+      proxy. For .nii.gz files, seeking is much faster if the package indexed_gzip is installed.
+    - Volumes loaded from a file name go through volume_cache, so that files that are loaded repeatedly (e.g. masks
+      shared across subjects or phantoms) are only read and decompressed once.
+    Args:
+        data: file name of a NIfTI image, nibabel image or array
+        bbox: tuple of slices, see get_bounding_box(). If None, return the full volume.
+    Returns:
+        ndarray
     """
-    average = np.average(values, weights=weights)
-    # Fast and numerically precise:
-    variance = np.average((values - average) ** 2, weights=weights)
-    return np.sqrt(variance)
+    # nibabel is imported on first use, so that commands that do not read images (e.g. --help, --merge) start faster
+    import nibabel
+    if isinstance(data, (str, os.PathLike)):
+        stat = os.stat(data)
+        key = (os.path.abspath(data), stat.st_mtime_ns, stat.st_size,
+               None if bbox is None else tuple((s.start, s.stop, s.step) for s in bbox))
+        data_cached = volume_cache.get(key)
+        if data_cached is None:
+            # Keep the file open, so that successive reads can reuse the gzip index built by indexed_gzip
+            data_cached = read_image(nibabel.load(data, keep_file_open=True), bbox)
+            volume_cache.put(key, data_cached)
+        return data_cached
+    if isinstance(data, nibabel.spatialimages.SpatialImage):
+        return read_image(data, bbox)
+    data = np.asarray(data)
+    return data if bbox is None else data[bbox]
 
 
-def main(argv=None):
+def read_image(img, bbox=None):
+    """Read the data of a nibabel image. See load_data()."""
+    import nibabel
+    dataobj = img.dataobj
+    if nibabel.is_proxy(dataobj):
+        is_scaled = dataobj.slope != 1 or dataobj.inter != 0
+        if bbox is not None:
+            data_crop = dataobj[bbox]
+            return data_crop.astype(np.float32, copy=False) if is_scaled else data_crop
+        if is_scaled:
+            return img.get_fdata(dtype=np.float32)
+    data = np.asanyarray(dataobj)
+    return data if bbox is None else data[bbox]
+
+
+def get_bounding_box(*masks):
+    """
+    Return the bounding box around the non-null voxels of the union of all masks.
+    Args:
+        masks: MaskIndex with the same shape
+    Returns:
+        tuple of slices: one slice per dimension. If all masks are empty, the slices cover the full volume.
+    """
+    coords = np.concatenate([np.array(mask.coords).reshape(3, -1) for mask in masks], axis=1)
+    if not coords.size:
+        return tuple(slice(None) for _ in masks[0].shape)
+    return tuple(slice(int(a), int(b) + 1) for a, b in zip(coords.min(axis=1), coords.max(axis=1)))
+
+
+def load_mask_index(mask, cache=False, slab_size=None):
+    """
+    Return the MaskIndex of a mask.
+    Args:
+        mask: file name of a NIfTI image, nibabel image, array or MaskIndex
+        cache: if True and mask is a file name, the index is saved next to the mask as "<MASK>.index.npz", and reused
+               by subsequent calls as long as the mask file is not modified.
+        slab_size: if provided, images are read by slabs of slab_size z-slices to build the index (see
+                   MaskIndex.from_mask()), instead of being loaded in memory.
+    Returns:
+        MaskIndex
+    """
+    if isinstance(mask, MaskIndex):
+        return mask
+    is_file = isinstance(mask, (str, os.PathLike))
+    if cache and is_file:
+        fname_cache = os.fspath(mask) + '.index.npz'
+        stat = os.stat(mask)
+        if os.path.isfile(fname_cache):
+            with np.load(fname_cache) as npz:
+                if npz['mtime_ns'] == stat.st_mtime_ns and npz['size'] == stat.st_size:
+                    return MaskIndex(tuple(int(n) for n in npz['shape']), npz['flat_index'], npz['indptr'],
+                                     npz['weights'])
+    import nibabel
+    if slab_size is not None and (is_file or isinstance(mask, nibabel.spatialimages.SpatialImage)):
+        img = nibabel.load(mask) if is_file else mask
+        mask_index = MaskIndex.from_mask(img.dataobj, slab_size=slab_size)
+    else:
+        mask_index = MaskIndex.from_mask(load_data(mask))
+    if cache and is_file:
+        try:
+            # Write in a temporary file first, so that parallel jobs never read a partially-written cache
+            with write_atomic(fname_cache, suffix='.npz') as fname_tmp:
+                np.savez(fname_tmp, shape=mask_index.shape, flat_index=mask_index.flat_index,
+                         indptr=mask_index.indptr, weights=mask_index.weights, mtime_ns=stat.st_mtime_ns,
+                         size=stat.st_size)
+        except OSError:
+            print(f"Could not write cache file: {fname_cache}")
+    return mask_index
+
+
+def combine_echoes(data):
+    """
+    Compute the root-mean-square across the 4th dimension (e.g. echoes of a multi-echo acquisition), echo by echo, so
+    that no 4d temporary is created. This is equivalent to "sct_maths -rms t".
+    Args:
+        data: 4d array
+    Returns:
+        3d array
+    """
+    sum_squares = np.zeros(data.shape[:3])
+    for i_echo in range(data.shape[3]):
+        sum_squares += np.square(data[..., i_echo], dtype=np.float64)
+    return np.sqrt(sum_squares / data.shape[3])
+
+
+def split_echoes(data, per_echo=False):
+    """
+    Return the list of 3d volumes on which to compute metrics.
+    Args:
+        data: 3d or 4d array
+        per_echo: if True and data is 4d, also return each echo
+    Returns:
+        list of 3d arrays: data itself if 3d. If 4d: root-mean-square across echoes, followed by each echo if per_echo.
+    """
+    if data is None or data.ndim == 3:
+        return [data]
+    volumes = [combine_echoes(data)]
+    if per_echo:
+        volumes += [data[..., i_echo] for i_echo in range(data.shape[3])]
+    return volumes
+
+
+def compute_slice_metrics(data1, mask_noise, mask_wm, mask_gm, data2=None, profiler=None):
+    """
+    Compute the slice-wise statistics required by compute_metrics().
+    Args:
+        data1: first volume (3d array)
+        mask_noise: mask where to compute noise (MaskIndex)
+        mask_wm: mask of white matter (MaskIndex)
+        mask_gm: mask of gray matter (MaskIndex)
+        data2: second volume (3d array). If None, the statistics for the *_diff metrics are not computed.
+        profiler: Profiler
+    Returns:
+        dict of 1d arrays, with one value per slice where the masks are not null
+    """
+    stats = {}
+    with profile_stage(profiler, 'stats_single'):
+        stats['mean_single'], stats['noise_single'] = compute_slice_stats(data1, mask_noise)
+        stats['mean_wm_single'], _ = compute_slice_stats(data1, mask_wm)
+        stats['mean_gm_single'], _ = compute_slice_stats(data1, mask_gm)
+    if data2 is not None:
+        with profile_stage(profiler, 'stats_diff'):
+            stats['mean_diff'], stats['noise_diff'], stats['mean_wm_diff'], stats['mean_gm_diff'] = \
+                compute_diff_stats(data1, data2, mask_noise, mask_wm, mask_gm)
+    return stats
+
+
+def compute_metrics(data1, mask_noise, mask_wm, mask_gm, data2=None, fname_json=None, cache_mask_index=False,
+                    slab_size=None, per_echo=False, profiler=None):
+    """
+    Compute SNR, contrast, CNR and CNR per unit time. The *_diff metrics are only computed if data2 is provided.
+    Each input can be a file name, a nibabel image or an array. Masks can also be a MaskIndex.
+    Args:
+        data1: first volume. If 4d (e.g. multi-echo), metrics are computed on the root-mean-square across the 4th
+               dimension, which is computed on the fly from a single read of the file.
+        mask_noise: mask where to compute noise
+        mask_wm: mask of white matter
+        mask_gm: mask of gray matter
+        data2: second volume (required for the "diff" method)
+        fname_json: JSON sidecar to fetch acquisition duration. If 'None', CNR per unit time is not computed.
+        cache_mask_index: if True, cache the index of each mask next to the mask file (see load_mask_index()).
+        slab_size: if provided, volumes are streamed by slabs of slab_size z-slices through the nibabel array proxy,
+                   so that memory usage is bounded by the size of a slab instead of the size of the volumes. Since
+                   statistics are computed slice-wise, results are identical to the in-memory computation.
+        per_echo: if True and inputs are 4d, also compute the metrics of each echo (see Results.echoes).
+        profiler: if provided, Profiler where to record the time and memory spent in each stage.
+    Returns:
+        Results
+    """
+    masks = []
+    for name, mask in zip(['noise', 'wm', 'gm'], [mask_noise, mask_wm, mask_gm]):
+        with profile_stage(profiler, 'load_mask_' + name):
+            masks.append(load_mask_index(mask, cache=cache_mask_index, slab_size=slab_size))
+    # Only the voxels within the masks are needed: crop all volumes around them, and only read that sub-volume of the
+    # images from disk
+    bbox = get_bounding_box(*masks)
+    if slab_size is None:
+        bbox_slabs = [bbox]
+    else:
+        import nibabel
+        # Open files once, so that successive slabs are read from the same file handle (and gzip index)
+        data1, data2 = [nibabel.load(data, keep_file_open=True) if isinstance(data, (str, os.PathLike)) else data
+                        for data in [data1, data2]]
+        zmin, zmax, _ = bbox[2].indices(masks[0].shape[2])
+        bbox_slabs = [bbox[:2] + (slice(z, min(z + slab_size, zmax)),) for z in range(zmin, zmax, slab_size)]
+    # Compute the statistics of each slab, for each volume (i.e. data itself, or the combination of all echoes followed
+    # by each echo). Slabs contain whole slices, so that the slice-wise statistics of the full volume are obtained by
+    # concatenating those of each slab.
+    stats_slabs = []
+    for bbox_slab in bbox_slabs:
+        masks_slab = [mask.crop(bbox_slab) for mask in masks]
+        with profile_stage(profiler, 'load_data1'):
+            volumes1 = split_echoes(load_data(data1, bbox_slab), per_echo)
+        if data2 is None:
+            volumes2 = [None] * len(volumes1)
+        else:
+            with profile_stage(profiler, 'load_data2'):
+                volumes2 = split_echoes(load_data(data2, bbox_slab), per_echo)
+        stats_slabs.append([compute_slice_metrics(volume1, *masks_slab, data2=volume2, profiler=profiler)
+                            for volume1, volume2 in zip(volumes1, volumes2)])
+    results = []
+    with profile_stage(profiler, 'cnr'):
+        for i_volume in range(len(stats_slabs[0])):
+            stats = {key: np.concatenate([stats_slab[i_volume][key] for stats_slab in stats_slabs])
+                     for key in stats_slabs[0][i_volume]}
+            results.append(compute_results(stats, fname_json))
+    if len(results) > 1:
+        results[0].echoes = results[1:]
+    return results[0]
+
+
+def compute_results(stats, fname_json=None):
+    """
+    Compute metrics from slice-wise statistics.
+    Args:
+        stats: dict of slice-wise statistics, see compute_slice_metrics(). Statistics can have trailing axes (e.g.
+               noise realizations), in which case each metric is an array with the same trailing axes.
+        fname_json: JSON sidecar to fetch acquisition duration. If 'None', CNR per unit time is not computed.
+    Returns:
+        Results
+    """
     # No correction for Rician noise because the noise mask is in a region of high SNR regime (not in the background)
     rayleigh_correction = False
-    # get arguments
-    parser = get_parser()
-    args = parser.parse_args(argv)
-    data1 = nibabel.load(args.data1).get_fdata()
-    nx, ny, nz = data1.shape
-    mask = nibabel.load(args.mask_noise).get_fdata()
-    mask_wm = nibabel.load(args.mask_wm).get_fdata()
-    mask_gm = nibabel.load(args.mask_gm).get_fdata()
-
-    # Compute mean in ROI for each z-slice, if the slice in the mask is not null
-    mean_in_roi = \
-        [np.average(data1[..., iz], weights=mask[..., iz]) for iz in range(nz) if np.any(mask[..., iz])]
-    noise_single_slice = \
-        [weighted_std(data1[..., iz], weights=mask[..., iz]) for iz in range(nz) if np.any(mask[..., iz])]
-    snr_single_slice = [m / s for m, s in zip(mean_in_roi, noise_single_slice)]
+    # Compute SNR from the mean and STD in ROI for each z-slice
+    snr_single_slice = stats['mean_single'] / stats['noise_single']
     if rayleigh_correction:
         # Correcting for Rayleigh noise (see eq. A12 in Dietrich et al.)
-        snr_single_slice = [snr_single_slice[iz] * np.sqrt((4 - np.pi) / 2) for iz in range(len(snr_single_slice))]
-    snr_single = sum(snr_single_slice) / len(snr_single_slice)
-    contrast, cnr_single, cnr_single_time = compute_cnr_time(data1, mask_wm, mask_gm, noise_single_slice, args.json)
-
-    # Try opening data2. If it fails, inform the user and do not compute *_diff metrics
-    try:
-        data2 = nibabel.load(args.data2).get_fdata()
-        # Compute mean across the two volumes
-        data_mean = (data1 + data2) / 2
-        # Compute mean in ROI for each z-slice, if the slice in the mask is not null
-        mean_in_roi = [np.average(data_mean[..., iz], weights=mask[..., iz])
-                       for iz in range(nz) if np.any(mask[..., iz])]
-        data_sub = data2 - data1
-        # Compute STD in the ROI for each z-slice. The "np.sqrt(2)" results from the variance of the subtraction of two
-        # distributions: var(A-B) = var(A) + var(B).
-        # More context in: https://github.com/spinalcordtoolbox/spinalcordtoolbox/issues/3481
-        noise_diff_slice = [weighted_std(data_sub[..., iz] / np.sqrt(2), weights=mask[..., iz])
-                            for iz in range(nz) if np.any(mask[..., iz])]
-        # Compute SNR
-        snr_roi_slicewise = [m / s for m, s in zip(mean_in_roi, noise_diff_slice)]
-        snr_diff = sum(snr_roi_slicewise) / len(snr_roi_slicewise)
+        snr_single_slice = snr_single_slice * np.sqrt((4 - np.pi) / 2)
+    snr_single = np.mean(snr_single_slice, axis=0)
+    contrast, cnr_single, cnr_single_time = compute_cnr_time_from_means(
+        stats['mean_wm_single'], stats['mean_gm_single'], stats['noise_single'], fname_json)
+
+    if 'mean_diff' in stats:
+        # Compute SNR, from the mean and noise across the two volumes
+        snr_roi_slicewise = stats['mean_diff'] / stats['noise_diff']
+        snr_diff = np.mean(snr_roi_slicewise, axis=0)
         # Compute CNR
-        # Note: we compute (and overwrite) the contrast on the 'diff' case because here we are using the mean data 
+        # Note: we compute (and overwrite) the contrast on the 'diff' case because here we are using the mean data
         # across two volumes, which improves the precision of the contrast estimation.
-        contrast, cnr_diff, cnr_diff_time = compute_cnr_time(data_mean, mask_wm, mask_gm, noise_diff_slice, args.json)
-    except FileNotFoundError:
+        contrast, cnr_diff, cnr_diff_time = compute_cnr_time_from_means(
+            stats['mean_wm_diff'], stats['mean_gm_diff'], stats['noise_diff'], fname_json)
+    else:
+        snr_diff, cnr_diff, cnr_diff_time = None, None, None
+
+    return Results(snr_single=snr_single, snr_diff=snr_diff, contrast=contrast, cnr_single=cnr_single,
+                   cnr_diff=cnr_diff, cnr_single_time=cnr_single_time, cnr_diff_time=cnr_diff_time)
+
+
+def check_data2(fname_data2):
+    """Return fname_data2 if the file exists. Otherwise, inform the user and return None."""
+    if fname_data2 is None or not os.path.isfile(fname_data2):
         print("'--data2' does not exist. Will not compute *_diff metrics.")
-        # need to assign empty strings variables
-        snr_diff, cnr_diff, cnr_diff_time = '', '', ''
+        return None
+    return fname_data2
 
-    # If user asked for output in a CSV file, aggregate results and write file
+
+def main(argv=None):
+    # get arguments
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    # Imported here, since both modules import this one
+    from gmchallenge import compute_cnr_batch, compute_cnr_server
+
+    if args.serve:
+        compute_cnr_server.serve(args.socket, jobs=args.jobs)
+        return
+
+    if args.merge:
+        if args.output is None:
+            parser.error("'--output' is required with '--merge'.")
+        try:
+            compute_cnr_batch.merge_results_shards(args.output)
+        except FileNotFoundError as e:
+            sys.exit(f"{e}. {args.output} was left untouched.")
+        return
+
+    if args.batch is not None:
+        if args.output is None:
+            parser.error("'--output' is required with '--batch'.")
+        try:
+            failed = compute_cnr_batch.run_batch(args.batch, args.output, jobs=args.jobs, profile=args.profile,
+                                                 cache_mask_index=args.cache_mask_index, slab_size=args.slab_size,
+                                                 per_echo=args.per_echo)
+        except ValueError as e:
+            # Errors of each subject are reported by run_batch(), so this is an invalid manifest
+            parser.error(f"Invalid manifest: {e}")
+        if failed:
+            sys.exit(f"{len(failed)} subject(s) failed: {', '.join(failed)}")
+        return
+
+    profiler = Profiler() if args.profile else None
+    # Check if data2 exists. If not, inform the user and do not compute *_diff metrics
+    results = compute_metrics(args.data1, args.mask_noise, args.mask_wm, args.mask_gm,
+                              data2=check_data2(args.data2), fname_json=args.json,
+                              cache_mask_index=args.cache_mask_index, slab_size=args.slab_size,
+                              per_echo=args.per_echo, profiler=profiler)
+
+    # If user asked for output in a CSV file, write the results of this subject. They are merged with those of the
+    # other subjects with '--merge'.
     if args.output is not None:
-        fname_out = args.output
-        if not os.path.isfile(fname_out):
-            # Add a header in case the file does not exist yet
-            with open(fname_out, 'w') as f:
-                f.write(f"Subject,SNR_single,SNR_diff,Contrast,CNR_single,CNR_diff,CNR_single/t,CNR_diff/t\n")
-        with open(fname_out, 'a') as f:
-            f.write(f"{args.subject},{snr_single},{snr_diff},{contrast},{cnr_single},{cnr_diff},{cnr_single_time},"
-                    f"{cnr_diff_time}\n")
+        with profile_stage(profiler, 'write_output'):
+            compute_cnr_batch.write_results_shard(args.output, args.subject, results)
+        if profiler is not None:
+            compute_cnr_batch.write_profile(args.output, args.subject, profiler.to_dict())
     # Otherwise, return to caller function
     else:
-        # Aggregate results into a clean dictionary
-        results = {
-            'SNR_single': snr_single,
-            'SNR_diff': snr_diff,
-            'Contrast': contrast,
-            'CNR_single': cnr_single,
-            'CNR_diff': cnr_diff,
-            'CNR_single_time': cnr_single_time,
-            'CNR_diff_time': cnr_diff_time
-            }
-        return results
+        if profiler is not None:
+            print(json.dumps(profiler.to_dict(), indent=2))
+        return results.to_dict()
 
 
 if __name__ == "__main__":
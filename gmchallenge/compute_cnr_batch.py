@@ -0,0 +1,208 @@
+# Results of compute_cnr across subjects: batch mode (--batch), per-subject shards written by parallel jobs, and their
+# merge into a single CSV file and profile (--merge).
+#
+# Kept out of compute_cnr.py, so that its hash only versions the code of the metrics (see utils.py).
+
+import csv
+import glob
+import json
+import os
+import sys
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from gmchallenge import compute_cnr
+from gmchallenge.utils import Profiler, get_jobs, write_atomic
+
+
+# Columns of the manifest of --batch. Optional columns can be absent or left empty.
+MANIFEST_COLUMNS = ['subject', 'data1', 'data2', 'mask-noise', 'mask-wm', 'mask-gm', 'json']
+MANIFEST_OPTIONAL_COLUMNS = ['data2', 'json']
+
+
+def read_manifest(fname_manifest):
+    """
+    Read the CSV manifest used by the batch mode. A ValueError is raised if a required column is missing from the
+    header, or if a row has more cells than the header or an empty required cell (naming the faulty line).
+    Args:
+        fname_manifest: CSV file with columns: subject, data1, data2, mask-noise, mask-wm, mask-gm, json
+    Returns:
+        list of dict: one dict per subject. Relative paths are converted to paths relative to the manifest, and empty
+                      cells are set to None.
+    """
+    path_manifest = os.path.dirname(os.path.abspath(fname_manifest))
+    rows = []
+    with open(fname_manifest, newline='') as f:
+        reader = csv.DictReader(f)
+        header = [name.strip() for name in reader.fieldnames or []]
+        required = [name for name in MANIFEST_COLUMNS if name not in MANIFEST_OPTIONAL_COLUMNS]
+        missing = [name for name in required if name not in header]
+        if missing:
+            raise ValueError(f"{fname_manifest}: missing column(s) in the header: {', '.join(missing)}")
+        reader.fieldnames = header
+        for row in reader:
+            if None in row:
+                raise ValueError(f"{fname_manifest}, line {reader.line_num}: more cells than columns in the header")
+            row = {key: value.strip() if value else None for key, value in row.items()}
+            empty = [name for name in required if not row[name]]
+            if empty:
+                raise ValueError(f"{fname_manifest}, line {reader.line_num}: empty cell(s): {', '.join(empty)}")
+            for key in MANIFEST_COLUMNS[1:]:
+                if row.get(key):
+                    row[key] = os.path.join(path_manifest, row[key])
+                else:
+                    row[key] = None
+            rows.append(row)
+    return rows
+
+
+def process_manifest_row(row, profile=False, **kwargs):
+    """
+    Compute metrics for one row of the manifest. Return a tuple: (subject, Results, profile, error), where profile is
+    the dict of the Profiler if profile is True, None otherwise. If the metrics cannot be computed (e.g. missing file),
+    Results and profile are None and error is the traceback, so that the other subjects are not lost.
+    kwargs are passed to compute_cnr.compute_metrics().
+    """
+    profiler = Profiler() if profile else None
+    try:
+        results = compute_cnr.compute_metrics(row['data1'], row['mask-noise'], row['mask-wm'], row['mask-gm'],
+                                              data2=compute_cnr.check_data2(row['data2']), fname_json=row['json'],
+                                              profiler=profiler, **kwargs)
+    except Exception:
+        return row['subject'], None, None, traceback.format_exc()
+    return row['subject'], results, None if profiler is None else profiler.to_dict(), None
+
+
+def run_batch(fname_manifest, fname_out, jobs=1, profile=False, **kwargs):
+    """
+    Compute metrics for all subjects listed in a manifest, and write all results in a single CSV file. Subjects that
+    fail are reported, and the results of the other subjects are written.
+    Args:
+        fname_manifest: CSV manifest, see read_manifest()
+        fname_out: CSV output file. Overwritten if it already exists.
+        jobs: number of parallel processes. If <= 0, use all the available CPU cores.
+        profile: if True, write the profile of each subject and the aggregated profile (see write_profile())
+        kwargs: passed to compute_cnr.compute_metrics(), e.g. cache_mask_index
+    Returns:
+        list of subjects that failed
+    """
+    rows = read_manifest(fname_manifest)
+    process_row = partial(process_manifest_row, profile=profile, **kwargs)
+    jobs = get_jobs(jobs)
+    if jobs == 1:
+        results_all = [process_row(row) for row in rows]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results_all = list(executor.map(process_row, rows))
+    failed = []
+    for subject, _, _, error in results_all:
+        if error is not None:
+            print(f"Subject {subject} failed:\n{error}", file=sys.stderr)
+            failed.append(subject)
+    results_all = [output for output in results_all if output[3] is None]
+    write_csv_atomic(fname_out,
+                     [row for subject, results, _, _ in results_all for row in results.to_csv_rows(subject)])
+    if profile:
+        for subject, _, profile_subject, _ in results_all:
+            write_profile(fname_out, subject, profile_subject)
+        merge_profiles(fname_out)
+    return failed
+
+
+def write_csv_atomic(fname_out, rows):
+    """
+    Write the CSV header and rows in fname_out, through a temporary file (see write_atomic()).
+    Args:
+        fname_out: CSV output file
+        rows: list of CSV lines (without line return), see compute_cnr.Results.to_csv_rows()
+    """
+    with write_atomic(fname_out) as fname_tmp, open(fname_tmp, 'w') as f:
+        f.write(','.join(['Subject'] + compute_cnr.CSV_COLUMNS) + '\n')
+        for row in rows:
+            f.write(row + '\n')
+
+
+def write_results_shard(fname_out, subject, results):
+    """
+    Write the results of one subject in its own shard file under "<fname_out>.shards/". Parallel jobs never write to
+    the same shard, so no lock is required (which would not be reliable on network file systems), and re-running a
+    subject overwrites its shard instead of adding a duplicate row. Shards are merged into fname_out once all jobs are
+    finished (see merge_results_shards()).
+    Args:
+        fname_out: CSV output file
+        subject: subject ID
+        results: compute_cnr.Results
+    """
+    os.makedirs(fname_out + '.shards', exist_ok=True)
+    write_csv_atomic(get_shard_name(fname_out, subject), results.to_csv_rows(subject))
+
+
+def get_shard_name(fname_out, subject, ext='.csv'):
+    """
+    Return the file name of the shard of subject under "<fname_out>.shards/".
+    """
+    return os.path.join(fname_out + '.shards', subject.replace(os.sep, '_') + ext)
+
+
+def write_profile(fname_out, subject, profile):
+    """
+    Write the profile of one subject in "<fname_out>.shards/<subject>.profile.json", next to its results.
+    Args:
+        fname_out: CSV output file
+        subject: subject ID
+        profile: dict, see Profiler.to_dict()
+    """
+    fname_profile = get_shard_name(fname_out, subject, '.profile.json')
+    os.makedirs(os.path.dirname(fname_profile), exist_ok=True)
+    with write_atomic(fname_profile) as fname_tmp, open(fname_tmp, 'w') as f:
+        json.dump(dict(subject=subject, **profile), f, indent=2)
+
+
+def merge_profiles(fname_out):
+    """
+    Aggregate the profiles of all subjects under "<fname_out>.shards/" into "<fname_out>.profile.json": times are
+    summed across subjects and memory (see Profiler) is the maximum across subjects, so that the stages where time
+    goes across a cohort can be compared at a glance. Does nothing if no profile was written.
+    Args:
+        fname_out: CSV output file
+    """
+    fname_profiles = sorted(glob.glob(os.path.join(fname_out + '.shards', '*.profile.json')))
+    if not fname_profiles:
+        return
+    stages = OrderedDict()
+    for fname_profile in fname_profiles:
+        with open(fname_profile) as f:
+            profile = json.load(f)
+        for name, stage in profile['stages'].items():
+            stage_all = stages.setdefault(name, {'calls': 0, 'wall_time': 0., 'cpu_time': 0.,
+                                                 'maxrss_increase_mb': 0., 'maxrss_mb': 0.})
+            for key in ['calls', 'wall_time', 'cpu_time']:
+                stage_all[key] += stage[key]
+            for key in ['maxrss_increase_mb', 'maxrss_mb']:
+                stage_all[key] = max(stage_all[key], stage[key])
+    profiler = Profiler()
+    profiler.stages = stages
+    with write_atomic(fname_out + '.profile.json') as fname_tmp, open(fname_tmp, 'w') as f:
+        json.dump(dict(subjects=len(fname_profiles), **profiler.to_dict()), f, indent=2)
+
+
+def merge_results_shards(fname_out):
+    """
+    Merge all shards under "<fname_out>.shards/" into fname_out, sorted by subject, as well as the profiles (see
+    merge_profiles()). Run once all jobs are finished. If no shard is found (e.g. wrong path), FileNotFoundError is
+    raised and fname_out is left untouched.
+    Args:
+        fname_out: CSV output file
+    """
+    fname_shards = sorted(glob.glob(os.path.join(fname_out + '.shards', '*.csv')))
+    if not fname_shards:
+        raise FileNotFoundError(f"No results to merge in: {fname_out + '.shards'}")
+    rows = []
+    for fname_shard in fname_shards:
+        with open(fname_shard) as f:
+            # Skip header
+            rows += f.read().splitlines()[1:]
+    write_csv_atomic(fname_out, rows)
+    merge_profiles(fname_out)
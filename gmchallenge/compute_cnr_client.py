@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# Thin client for a compute_cnr server (started with "compute_cnr --serve"). It accepts the same flags as compute_cnr,
+# forwards them to the server through a Unix socket and prints the output of the server. If no server is running, the
+# request is processed locally by compute_cnr.
+#
+# USAGE:
+#   compute_cnr --serve --jobs 8 &
+#   compute_cnr_client --data1 data1.nii.gz --data2 data2.nii.gz --mask-noise ... --output results.csv
+#
+# This module is kept free of heavy imports (numpy, nibabel), so that the client starts fast.
+
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+
+
+# The socket is in a directory which only the user can access (see compute_cnr_server.make_private_dir())
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), f"compute_cnr-{os.getuid()}", 'server.sock')
+
+
+def send_request(fname_socket, argv):
+    """
+    Send a compute_cnr request to the server.
+    Args:
+        fname_socket: Unix socket the server listens to
+        argv: list of compute_cnr arguments
+    Returns:
+        dict: response of the server, with keys: status, stdout, stderr. ValueError is raised if the response is empty
+              or invalid.
+    """
+    # Never send a request to a server of another user
+    if os.stat(fname_socket).st_uid != os.getuid():
+        raise ConnectionRefusedError(f"{fname_socket} belongs to another user.")
+    # Send the working directory, so that relative paths are resolved as if compute_cnr was run locally
+    request = {'argv': argv, 'cwd': os.getcwd()}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(fname_socket)
+        with sock.makefile('rwb') as f:
+            f.write((json.dumps(request) + '\n').encode())
+            f.flush()
+            response = json.loads(f.readline())
+    if not isinstance(response, dict) or not {'status', 'stdout', 'stderr'} <= response.keys():
+        raise ValueError(f"Invalid response from the server: {response}")
+    return response
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
+    args, argv_cnr = parser.parse_known_args(argv)
+    try:
+        response = send_request(args.socket, argv_cnr)
+    except (FileNotFoundError, ConnectionRefusedError, ConnectionResetError, ValueError):
+        # No server is running, or the server did not send a valid response (ValueError, e.g. if it stopped while
+        # processing the request): process the request locally
+        from gmchallenge import compute_cnr
+        compute_cnr.main(argv_cnr)
+        return
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    sys.exit(response['status'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+# Server of compute_cnr ("compute_cnr --serve"): it listens to a Unix socket and processes the requests of
+# compute_cnr_client in a pool of worker processes, which only import numpy and nibabel once.
+#
+# Kept out of compute_cnr.py, so that its hash only versions the code of the metrics (see utils.py).
+
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stdout, redirect_stderr
+
+from gmchallenge import compute_cnr
+from gmchallenge.compute_cnr_client import DEFAULT_SOCKET
+from gmchallenge.utils import get_jobs
+
+
+def run_request(request):
+    """
+    Run compute_cnr in a worker process of the server.
+    Args:
+        request: dict with keys: argv (list of compute_cnr arguments), cwd (working directory of the client)
+    Returns:
+        dict: response with keys: status (exit code), stdout, stderr
+    """
+    stdout, stderr = io.StringIO(), io.StringIO()
+    status = 0
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            # Parse arguments as compute_cnr.main() does, so that abbreviations of '--serve' (e.g. '--serv') are also
+            # rejected
+            if compute_cnr.get_parser().parse_args(request['argv']).serve:
+                raise ValueError("'--serve' cannot be sent to a server.")
+            os.chdir(request['cwd'])
+            compute_cnr.main(request['argv'])
+        except SystemExit as e:
+            # Raised by argparse, e.g. with '--help' or invalid arguments
+            status = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+    return {'status': status, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Read one JSON request per connection, process it in the worker pool and send back the JSON response. A response is
+    always sent, even if the request cannot be processed, so that the client never waits for a reply that never comes.
+    """
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # Connection closed without a request, e.g. by is_server_running()
+            return
+        try:
+            request = json.loads(line)
+            response = self.server.run(request)
+        except Exception:
+            response = {'status': 1, 'stdout': '', 'stderr': traceback.format_exc()}
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    """
+    Unix socket server which processes requests in a pool of worker processes. If a worker dies (e.g. killed when
+    running out of memory), the pool cannot process any further request: it is then replaced by a new pool.
+    """
+    def __init__(self, fname_socket, jobs):
+        super().__init__(fname_socket, RequestHandler)
+        self.jobs = jobs
+        self.executor = ProcessPoolExecutor(max_workers=jobs)
+        self._lock = threading.Lock()
+
+    def server_bind(self):
+        # Only the user can connect to the socket. The umask is set while binding, so that the socket is never
+        # accessible to other users, even briefly.
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+    def run(self, request):
+        """Process a request in the worker pool, and return the response (see run_request())"""
+        executor = self.executor
+        try:
+            return executor.submit(run_request, request).result()
+        except BrokenProcessPool:
+            with self._lock:
+                # Other requests that were running in the same pool also fail: only replace the pool once
+                if self.executor is executor:
+                    executor.shutdown(wait=False)
+                    self.executor = ProcessPoolExecutor(max_workers=self.jobs)
+            return {'status': 1, 'stdout': '',
+                    'stderr': "A worker process of the server died while processing the request (e.g. because it ran "
+                              "out of memory). The workers were restarted.\n"}
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+
+
+def serve(fname_socket, jobs=1):
+    """
+    Listen to a Unix socket and process compute_cnr requests (see compute_cnr_client) until interrupted.
+    Args:
+        fname_socket: Unix socket to listen to. Removed when the server stops.
+        jobs: number of worker processes. If <= 0, use all the available CPU cores.
+    """
+    jobs = get_jobs(jobs)
+    # Import nibabel before starting the workers, so that they inherit it instead of importing it on their first request
+    import nibabel  # noqa: F401
+    if os.path.abspath(fname_socket) == DEFAULT_SOCKET:
+        make_private_dir(os.path.dirname(DEFAULT_SOCKET))
+    if os.path.exists(fname_socket):
+        if is_server_running(fname_socket):
+            sys.exit(f"A server is already listening on {fname_socket}.")
+        # Remove socket left by a server that was not stopped properly
+        os.remove(fname_socket)
+    # Stop properly (and remove the socket) when terminated, e.g. by a job scheduler
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with Server(fname_socket, jobs) as server:
+        inode = os.stat(fname_socket).st_ino
+        print(f"Listening on {fname_socket} with {jobs} worker(s). Press CTRL+C to stop.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Only remove the socket if it was not replaced, e.g. by another server after this one was unreachable
+            if os.path.exists(fname_socket) and os.stat(fname_socket).st_ino == inode:
+                os.remove(fname_socket)
+
+
+def is_server_running(fname_socket):
+    """Return True if a server accepts connections on the Unix socket fname_socket"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(fname_socket)
+        except (ConnectionRefusedError, FileNotFoundError):
+            return False
+    return True
+
+
+def make_private_dir(path):
+    """
+    Create a directory which only the user can access, e.g. for the socket of the server in a shared temporary
+    directory. Exit if the directory already exists and belongs to another user or is accessible by other users.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    stat = os.stat(path)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        sys.exit(f"{path} must belong to the current user and must not be accessible by other users.")
@@ -2,16 +2,15 @@
 #
 # Generate figures for the spine-generic results
 
-import pandas as pd
 import numpy as np
 import argparse
 import os
-import matplotlib.pyplot as plt
-import ptitprince as pt
-import seaborn as sns
-from matplotlib.patches import PathPatch
 
-sns.set(style="whitegrid", font_scale=1)
+# Plotting libraries and pandas are imported in the functions that need them, so that the script starts fast (e.g. for
+# --help) and importing this module does not change the global plotting style.
+
+# Number of bins of the binned rendering of subjects, see plot_binned_strip()
+N_BINS = 40
 
 
 def get_parser():
@@ -25,6 +24,11 @@ def get_parser():
     parser.add_argument("-o", "--path-output",
                         help="Path to save images",
                         required=True)
+    parser.add_argument("--max-points",
+                        help="Maximum number of subjects drawn as individual points. Above it, subjects are drawn as "
+                             "binned counts, which renders large cohorts much faster. Default=2000.",
+                        type=int,
+                        default=2000)
     return parser
 
 
@@ -33,6 +37,7 @@ def adjust_box_widths(g, fac):
     Adjust the widths of a seaborn-generated boxplot.
     Source: From https://github.com/mwaskom/seaborn/issues/1076#issuecomment-634541579
     """
+    from matplotlib.patches import PathPatch
     # iterating through Axes instances
     for ax in g.axes:
 
@@ -63,34 +68,68 @@ def adjust_box_widths(g, fac):
                             l.set_xdata([xmin_new, xmax_new])
 
 
-def generate_figure(data_in, column, path_output):
+def plot_binned_strip(ax, data_in, column, hue, palette, width=.8):
+    """
+    Draw the distribution of column for each hue as binned counts, at the positions of the points of a dodged
+    stripplot: one marker per non-empty bin, with an area proportional to the number of subjects in the bin. The number
+    of markers does not depend on the number of subjects.
+    Args:
+        ax: matplotlib Axes
+        data_in: DataFrame
+        column: column to plot
+        hue: column used to split subjects
+        palette: list of colors, one per hue value
+        width: width of the group of all hues, as in seaborn
+    """
+    values = data_in[column].to_numpy(dtype=float)
+    bins = np.histogram_bin_edges(values[np.isfinite(values)], bins=N_BINS)
+    centers = 0.5 * (bins[:-1] + bins[1:])
+    # Same order of hue values as seaborn, i.e. order of appearance
+    hue_values = data_in[hue].dropna().unique()
+    width_hue = width / len(hue_values)
+    for i_hue, hue_value in enumerate(hue_values):
+        counts, _ = np.histogram(values[(data_in[hue] == hue_value).to_numpy()], bins=bins)
+        is_used = counts > 0
+        ax.scatter(np.full(is_used.sum(), -width / 2 + width_hue * (i_hue + 0.5)), centers[is_used],
+                   s=20 * counts[is_used] / counts.max(), color=palette[i_hue % len(palette)], edgecolor="white",
+                   zorder=0)
+
+
+def generate_figure(data_in, column, path_output, max_points=2000):
+    """
+    Generate a raincloud figure (half violin, box and points) of column, split by manufacturer.
+    Args:
+        data_in: DataFrame with columns column and "Manufacturer", already scaled for display
+        column: column to plot
+        path_output: folder to save the figure
+        max_points: maximum number of subjects drawn as individual points. Above it, see plot_binned_strip().
+    """
+    import matplotlib.pyplot as plt
+    import ptitprince as pt
+    import seaborn as sns
     dx = np.ones(len(data_in[column]))
     dy = column
     hue = "Manufacturer"
     pal = ["#1E90FF", "#32CD32", "#FF0000"]
     f, ax = plt.subplots(figsize=(4, 6))
-    if column == 'CNR_single/t':
-        coeff = 100
-    else:
-        coeff = 1
-    ax = pt.half_violinplot(x=dx, y=dy, data=data_in*coeff, hue=hue, palette=pal, bw=.4, cut=0., linewidth=0.,
+    ax = pt.half_violinplot(x=dx, y=dy, data=data_in, hue=hue, palette=pal, bw=.4, cut=0., linewidth=0.,
                             scale="area", width=.8, inner=None, orient="v", dodge=False, alpha=.4, offset=0.5)
-    ax = sns.boxplot(x=dx, y=dy, data=data_in*coeff, hue=hue, color="black", palette=pal,
+    ax = sns.boxplot(x=dx, y=dy, data=data_in, hue=hue, color="black", palette=pal,
                      showcaps=True, boxprops={'facecolor': 'none', "zorder": 10}, showmeans=True,
                      meanprops={"marker": "^", "markerfacecolor": "black", "markeredgecolor": "black",
                                     "markersize": "8"},
-                     showfliers=True, whiskerprops={'linewidth': 2, "zorder": 10},
+                     showfliers=len(data_in) <= max_points, whiskerprops={'linewidth': 2, "zorder": 10},
                      saturation=1, orient="v", dodge=True)
-    ax = sns.stripplot(x=dx, y=dy, data=data_in*coeff, hue=hue, palette=pal, edgecolor="white",
-                       size=3, jitter=1, zorder=0, orient="v", dodge=True)
+    if len(data_in) <= max_points:
+        ax = sns.stripplot(x=dx, y=dy, data=data_in, hue=hue, palette=pal, edgecolor="white",
+                           size=3, jitter=1, zorder=0, orient="v", dodge=True)
+    else:
+        plot_binned_strip(ax, data_in, column, hue, pal)
     plt.xlim([-1, 0.5])
     handles, labels = ax.get_legend_handles_labels()
-    # The code below doesn't work (the label for CNR is "GEGEGEGEGEGEG...") so i need to hard-code the labels (because
-    # I don't have time to dig further).
-    # _ = plt.legend(handles[0:len(labels) // 3], labels[0:len(labels) // 3],
-    #                bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
-    #                title=str(hue))
-    _ = plt.legend(handles[0:3], ['Philips', 'Siemens', 'GE'],
+    # Each layer adds one legend entry per manufacturer: only keep the first ones
+    n_hues = data_in[hue].nunique()
+    _ = plt.legend(handles[0:n_hues], labels[0:n_hues],
                    bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
                    title=str(hue))
     f.gca().invert_xaxis()
@@ -112,6 +151,7 @@ def generate_figure(data_in, column, path_output):
         top=False,
         labelbottom=False)
     plt.savefig(fname_out, bbox_inches='tight', dpi=300)
+    plt.close(f)
 
 
 def main(argv=None):
@@ -122,23 +162,29 @@ def main(argv=None):
     path_input_participants = args.path_input_participants
     path_output = args.path_output
 
+    import pandas as pd
+    import seaborn as sns
+    sns.set(style="whitegrid", font_scale=1)
+
     if not os.path.isdir(path_output):
         os.makedirs(path_output)
 
     content_results_csv = pd.read_csv(path_input_results, sep=",")
     content_participants_tsv = pd.read_csv(path_input_participants, encoding="ISO-8859-1", sep="\t")
 
-    list_subjects_results = content_results_csv['Subject'].tolist()
+    # Attach the manufacturer of each subject (the first entry of participants.tsv, if a participant is duplicated)
+    manufacturers = content_participants_tsv[['participant_id', 'manufacturer']].drop_duplicates('participant_id')
+    data = content_results_csv.merge(manufacturers, how='left', left_on='Subject', right_on='participant_id')
 
-    # loop across subjects list from results
-    for subj in list_subjects_results:
-        rowIndex = content_participants_tsv[content_participants_tsv['participant_id'] == subj].index
-        rowIndexResults = content_results_csv[content_results_csv['Subject'] == subj].index
-        content_results_csv.loc[rowIndexResults, 'Manufacturer'] = content_participants_tsv.loc[rowIndex]['manufacturer'].values[0]
+    # Single frame with the plotted columns, scaled for display
+    data = pd.DataFrame({'Manufacturer': data['manufacturer'],
+                         'SNR_single': data['SNR_single'],
+                         'Contrast': data['Contrast'],
+                         'CNR_single/t': data['CNR_single/t'] * 100})
 
-    generate_figure(content_results_csv, 'SNR_single', path_output)
-    generate_figure(content_results_csv, 'Contrast', path_output)
-    generate_figure(content_results_csv, 'CNR_single/t', path_output)
+    generate_figure(data, 'SNR_single', path_output, args.max_points)
+    generate_figure(data, 'Contrast', path_output, args.max_points)
+    generate_figure(data, 'CNR_single/t', path_output, args.max_points)
 
 
 if __name__ == "__main__":
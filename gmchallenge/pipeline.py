@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+#
+# Process a dataset with the steps of process_data.sh, modeled as a graph of stages. The outputs of each stage are
+# stored in a cache, keyed by a hash of the content of its inputs and of its parameters (command line, or code of the
+# Python function), so that re-running the pipeline only recomputes the stages whose inputs or parameters changed, and
+# the stages downstream of them.
+#
+# USAGE:
+#   gmchallenge --path-data <PATH_DATA> --path-output <PATH_OUT> [--jobs -1]
+#
+# OUTPUT:
+#   <PATH_OUT>/data_processed/<SUBJECT>/anat/: outputs of the stages
+#   <PATH_OUT>/results/results.csv: results of all subjects, see compute_cnr.py
+#   <PATH_OUT>/log/<SUBJECT>.log: output of the commands run for each subject
+#   <PATH_OUT>/qc/: quality control report (only updated by the stages which are recomputed)
+#   <PATH_OUT>/cache/: outputs of the stages, keyed by hash
+
+import argparse
+import glob
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import subprocess
+import sys
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from dataclasses import asdict, dataclass, field
+from functools import partial
+from typing import Callable, List, Optional
+
+from gmchallenge import compute_cnr, compute_cnr_batch, utils
+
+
+# Extension of the NIfTI files
+EXT = '.nii.gz'
+# Parameters of the registration of data2 on data1. Note: we use NearestNeighbour for final interpolation to not alter
+# noise distribution.
+PARAM_REGISTRATION = 'step=1,type=im,algo=rigid,metric=MeanSquares,smooth=1,slicewise=1,iter=50'
+# Version of the cache. Increase it to invalidate all cached outputs.
+CACHE_VERSION = 1
+
+
+@dataclass
+class Stage:
+    """
+    Step of the pipeline. Inputs and outputs are file names relative to the folder of the subject, except for inputs
+    outside of it (e.g. manual segmentations). A stage either runs commands (list of arguments, run in the folder of the
+    subject), and/or calls function(inputs, outputs) before the commands, in which case the source code of the function
+    and the files listed in code are part of the key of the stage.
+    """
+    name: str
+    inputs: List[str]
+    outputs: List[str]
+    commands: List[List[str]] = field(default_factory=list)
+    function: Optional[Callable] = None
+    code: List[str] = field(default_factory=list)
+    # If True, the QC arguments of SCT are added to the last command
+    qc: bool = False
+
+    def get_parameters(self):
+        """Return the parameters of the stage which are included in its key, besides the content of its inputs"""
+        parameters = {'commands': self.commands}
+        if self.function is not None:
+            parameters.update(function=inspect.getsource(self.function),
+                              code=[utils.hash_file(fname) for fname in self.code])
+        return parameters
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Process the data of the challenge, or of the spine-generic '
+                                                 'dataset, as process_data.sh. Outputs of each stage are cached, so '
+                                                 'that re-running the pipeline only recomputes the stages whose inputs '
+                                                 'or parameters changed.')
+    parser.add_argument("--path-data",
+                        help="Path to the dataset (BIDS).",
+                        required=True)
+    parser.add_argument("--path-output",
+                        help="Path where results will be output.",
+                        required=True)
+    parser.add_argument("--subjects",
+                        help="Subjects to process. Default: all folders of the dataset which contain an 'anat' folder.",
+                        nargs='+')
+    parser.add_argument("--jobs",
+                        help="Number of subjects processed in parallel. Set to -1 to use all the available CPU cores. "
+                             "Default=1.",
+                        type=int,
+                        default=1)
+    parser.add_argument("--path-cache",
+                        help="Path to the cache of the outputs of the stages, which can be shared across runs with "
+                             "different output paths. Default: <PATH_OUTPUT>/cache.")
+    return parser
+
+
+def copy_file(inputs, outputs):
+    """Copy a file, e.g. a manual segmentation"""
+    shutil.copyfile(inputs[0], outputs[0])
+
+
+def compute_metrics(inputs, outputs):
+    """
+    Compute the metrics with compute_cnr.
+    Args:
+        inputs: [data1, mask_noise, mask_wm, mask_gm, json] or [data1, mask_noise, mask_wm, mask_gm, json, data2]
+        outputs: [JSON file of the fields of compute_cnr.Results]
+    """
+    data1, mask_noise, mask_wm, mask_gm, fname_json = inputs[:5]
+    data2 = inputs[5] if len(inputs) > 5 else None
+    results = compute_cnr.compute_metrics(data1, mask_noise, mask_wm, mask_gm, data2=data2, fname_json=fname_json)
+    with open(outputs[0], 'w') as f:
+        json.dump(asdict(results), f, indent=2)
+
+
+def get_segmentation_stage(name, fname_in, fname_seg, fname_manual, command):
+    """
+    Return the stage which segments fname_in, or which copies the manual segmentation if it exists and generates its QC
+    with sct_qc, as in process_data.sh.
+    Args:
+        name: name of the stage
+        fname_in: file to segment
+        fname_seg: output segmentation
+        fname_manual: manual segmentation
+        command: command of the automatic segmentation, which is completed with the output file name
+    """
+    if os.path.isfile(fname_manual):
+        return Stage(name, [fname_manual, fname_in], [fname_seg], function=copy_file,
+                     commands=[['sct_qc', '-i', fname_in, '-s', fname_seg, '-p', command[0]]], qc=True)
+    return Stage(name, [fname_in], [fname_seg], commands=[command + ['-o', fname_seg]], qc=True)
+
+
+def get_stages(subject, path_data):
+    """
+    Return the stages of the processing of a subject, as in process_data.sh.
+    Args:
+        subject: subject ID
+        path_data: path to the dataset
+    Returns:
+        sources: list of file names of the dataset, which are copied in the folder of the subject
+        stages: list of Stage
+    """
+    path_anat = os.path.join(path_data, subject, 'anat')
+    path_manual = os.path.join(path_data, 'derivatives', 'labels', subject, 'anat')
+    # Accommodate file naming between GM challenge data and spine-generic data
+    if os.path.isfile(os.path.join(path_anat, f"{subject}_run-1_T2starw{EXT}")):
+        file_1, file_2 = f"{subject}_run-1_T2starw", f"{subject}_run-2_T2starw"
+    else:
+        file_1, file_2 = f"{subject}_T2star", None
+    file_json = file_1 + '.json'
+    sources = [file_1 + EXT, file_json] + ([file_2 + EXT] if file_2 is not None else [])
+    # Outputs of each stage have their own name (instead of overwriting their input as in process_data.sh), so that
+    # the content of each file only depends on the stage that produces it.
+    file_rms = file_1 + '_rms'
+    file_seg = file_1 + '_seg'
+    file_gmseg = file_1 + '_gmseg'
+    file_gmseg_raw = file_gmseg + '_raw'
+    file_mask = 'mask_' + file_1
+    file_crop = file_1 + '_crop'
+    file_seg_crop = file_seg + '_crop'
+    file_gmseg_crop = file_gmseg + '_crop'
+    file_wmseg = file_crop + '_wmseg'
+    file_wmseg_erode = file_wmseg + '_erode'
+    stages = [
+        # Compute root-mean square across 4th dimension (if it exists), corresponding to all echoes in Philips scans
+        Stage('rms', [file_1 + EXT], [file_rms + EXT],
+              commands=[['sct_maths', '-i', file_1 + EXT, '-rms', 't', '-o', file_rms + EXT]]),
+        # Segment spinal cord
+        get_segmentation_stage('seg', file_rms + EXT, file_seg + EXT,
+                               os.path.join(path_manual, file_seg + '-manual' + EXT),
+                               ['sct_deepseg_sc', '-i', file_rms + EXT, '-c', 't2s']),
+        # Segment gray matter
+        get_segmentation_stage('gmseg_raw', file_rms + EXT, file_gmseg_raw + EXT,
+                               os.path.join(path_manual, file_gmseg + '-manual' + EXT),
+                               ['sct_deepseg_gm', '-i', file_rms + EXT]),
+        # Converts GM segmentation to UINT8. See: https://github.com/spinalcordtoolbox/spinalcordtoolbox/issues/3488
+        Stage('gmseg', [file_gmseg_raw + EXT], [file_gmseg + EXT],
+              commands=[['sct_image', '-i', file_gmseg_raw + EXT, '-type', 'uint8', '-o', file_gmseg + EXT]]),
+        # Crop data (for faster processing)
+        Stage('mask', [file_rms + EXT, file_seg + EXT], [file_mask + EXT],
+              commands=[['sct_create_mask', '-i', file_rms + EXT, '-p', f"centerline,{file_seg}{EXT}", '-size', '35mm',
+                         '-o', file_mask + EXT]]),
+        Stage('crop', [file_rms + EXT, file_mask + EXT], [file_crop + EXT],
+              commands=[['sct_crop_image', '-i', file_rms + EXT, '-m', file_mask + EXT, '-o', file_crop + EXT]]),
+        Stage('crop_seg', [file_seg + EXT, file_mask + EXT], [file_seg_crop + EXT],
+              commands=[['sct_crop_image', '-i', file_seg + EXT, '-m', file_mask + EXT, '-o', file_seg_crop + EXT]]),
+        Stage('crop_gmseg', [file_gmseg + EXT, file_mask + EXT], [file_gmseg_crop + EXT],
+              commands=[['sct_crop_image', '-i', file_gmseg + EXT, '-m', file_mask + EXT, '-o',
+                         file_gmseg_crop + EXT]]),
+        # Generate white matter segmentation
+        Stage('wmseg', [file_seg_crop + EXT, file_gmseg_crop + EXT], [file_wmseg + EXT],
+              commands=[['sct_maths', '-i', file_seg_crop + EXT, '-sub', file_gmseg_crop + EXT, '-o',
+                         file_wmseg + EXT]]),
+        # Erode white matter mask to minimize partial volume effect
+        # Note: we cannot erode the gray matter because it is too thin (most of the time, only one voxel)
+        Stage('erode', [file_wmseg + EXT], [file_wmseg_erode + EXT],
+              commands=[['sct_maths', '-i', file_wmseg + EXT, '-erode', '1', '-o', file_wmseg_erode + EXT]]),
+    ]
+    inputs_cnr = [file_crop + EXT, file_wmseg_erode + EXT, file_wmseg + EXT, file_gmseg_crop + EXT, file_json]
+    # Register data2 on data1 (only for gm-challenge dataset)
+    if file_2 is not None:
+        file_2_reg = file_2 + '_reg'
+        stages.append(Stage('register', [file_2 + EXT, file_crop + EXT, file_seg_crop + EXT], [file_2_reg + EXT],
+                            commands=[['sct_register_multimodal', '-i', file_2 + EXT, '-d', file_crop + EXT,
+                                       '-dseg', file_seg_crop + EXT, '-param', PARAM_REGISTRATION, '-x', 'nn',
+                                       '-o', file_2_reg + EXT]],
+                            qc=True))
+        inputs_cnr.append(file_2_reg + EXT)
+    # Compute SNR and CNR
+    stages.append(Stage('compute_cnr', inputs_cnr, ['results.json'], function=compute_metrics,
+                        code=[compute_cnr.__file__]))
+    return sources, sort_stages(stages)
+
+
+def sort_stages(stages):
+    """
+    Sort stages so that each stage comes after the stages which produce its inputs.
+    Args:
+        stages: list of Stage
+    Returns:
+        list of Stage
+    """
+    producers = {output: stage.name for stage in stages for output in stage.outputs}
+    dependencies = OrderedDict((stage.name, {producers[fname] for fname in stage.inputs if fname in producers})
+                               for stage in stages)
+    by_name = {stage.name: stage for stage in stages}
+    stages_sorted = []
+    while dependencies:
+        ready = [name for name, deps in dependencies.items() if not deps - {stage.name for stage in stages_sorted}]
+        if not ready:
+            raise ValueError(f"Cycle between stages: {', '.join(dependencies)}")
+        for name in ready:
+            stages_sorted.append(by_name[name])
+            del dependencies[name]
+    return stages_sorted
+
+
+def get_stage_key(stage, path_subject):
+    """
+    Return the key of the outputs of a stage: a hash of the content of its inputs and of its parameters. Paths of the
+    folders are not included, so that the cache can be shared across output folders.
+    """
+    key = {'version': CACHE_VERSION, 'parameters': stage.get_parameters(), 'outputs': stage.outputs,
+           'inputs': [utils.hash_file(os.path.join(path_subject, fname)) for fname in stage.inputs]}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def copy_sources(path_source, path_subject, sources):
+    """Copy the files of the dataset in the folder of the subject, unless they are already up to date"""
+    for fname in sources:
+        fname_source = os.path.join(path_source, fname)
+        fname_subject = os.path.join(path_subject, fname)
+        stat_source = os.stat(fname_source)
+        if os.path.isfile(fname_subject):
+            stat_subject = os.stat(fname_subject)
+            if (stat_subject.st_size, stat_subject.st_mtime) == (stat_source.st_size, stat_source.st_mtime):
+                continue
+        shutil.copy2(fname_source, fname_subject)
+
+
+def run_stage(stage, path_subject, path_cache, log, qc_args):
+    """
+    Produce the outputs of a stage in the folder of the subject, from the cache if they were already computed with the
+    same inputs and parameters.
+    Args:
+        stage: Stage
+        path_subject: folder of the subject
+        path_cache: folder of the cache
+        log: file object, where the output of commands is written
+        qc_args: QC arguments of SCT commands
+    Returns:
+        bool: True if the stage was computed, False if its outputs were taken from the cache
+    """
+    key = get_stage_key(stage, path_subject)
+    path_key = os.path.join(path_cache, key[:2], key)
+    fname_stamp = os.path.join(path_subject, '.stages', stage.name)
+    if os.path.isdir(path_key):
+        # Outputs are already in the folder of the subject if they were last produced with the same key
+        if os.path.isfile(fname_stamp):
+            with open(fname_stamp) as f:
+                is_current = f.read() == key
+            if is_current and all(os.path.isfile(os.path.join(path_subject, fname)) for fname in stage.outputs):
+                return False
+        for fname in stage.outputs:
+            shutil.copyfile(os.path.join(path_key, fname), os.path.join(path_subject, fname))
+        computed = False
+    else:
+        log.write(f"--- Stage: {stage.name}\n")
+        log.flush()
+        if stage.function is not None:
+            stage.function([os.path.join(path_subject, fname) for fname in stage.inputs],
+                           [os.path.join(path_subject, fname) for fname in stage.outputs])
+        for i, command in enumerate(stage.commands):
+            if stage.qc and i == len(stage.commands) - 1:
+                command = command + qc_args
+            subprocess.run(command, cwd=path_subject, stdout=log, stderr=subprocess.STDOUT, check=True)
+        for fname in stage.outputs:
+            if not os.path.isfile(os.path.join(path_subject, fname)):
+                raise FileNotFoundError(f"Stage {stage.name} did not produce {fname}")
+        # Save outputs in the cache, in a temporary folder which is then renamed, so that concurrent runs never see a
+        # partially-written entry
+        path_tmp = f"{path_key}.{os.getpid()}.tmp"
+        os.makedirs(path_tmp)
+        for fname in stage.outputs:
+            shutil.copyfile(os.path.join(path_subject, fname), os.path.join(path_tmp, fname))
+        try:
+            os.rename(path_tmp, path_key)
+        except OSError:
+            # Another process saved the same outputs
+            shutil.rmtree(path_tmp)
+        computed = True
+    os.makedirs(os.path.dirname(fname_stamp), exist_ok=True)
+    with open(fname_stamp, 'w') as f:
+        f.write(key)
+    return computed
+
+
+def process_subject(subject, path_data, path_output, path_cache):
+    """
+    Run all the stages of a subject, and write its results in its shard of <path_output>/results/results.csv (see
+    compute_cnr_batch.write_results_shard()). If the processing fails, the shard of an earlier run is removed, so that
+    outdated results are not merged.
+    Returns:
+        subject: subject ID
+        stages_computed: list of names of the stages which were computed (others were taken from the cache)
+        error: traceback if the processing failed, None otherwise
+    """
+    path_subject = os.path.join(path_output, 'data_processed', subject, 'anat')
+    qc_args = ['-qc', os.path.join(path_output, 'qc'), '-qc-subject', subject]
+    fname_results = os.path.join(path_output, 'results', 'results.csv')
+    stages_computed = []
+    os.makedirs(path_subject, exist_ok=True)
+    os.makedirs(os.path.join(path_output, 'log'), exist_ok=True)
+    with open(os.path.join(path_output, 'log', subject + '.log'), 'w') as log:
+        try:
+            sources, stages = get_stages(subject, path_data)
+            copy_sources(os.path.join(path_data, subject, 'anat'), path_subject, sources)
+            for stage in stages:
+                if run_stage(stage, path_subject, path_cache, log, qc_args):
+                    stages_computed.append(stage.name)
+            with open(os.path.join(path_subject, 'results.json')) as f:
+                results = compute_cnr.Results(**json.load(f))
+            # Same output as process_data.sh. Shards of all subjects are merged once all subjects are processed.
+            compute_cnr_batch.write_results_shard(fname_results, subject, results)
+        except Exception:
+            error = traceback.format_exc()
+            log.write(error)
+            fname_shard = compute_cnr_batch.get_shard_name(fname_results, subject)
+            if os.path.isfile(fname_shard):
+                os.remove(fname_shard)
+            return subject, stages_computed, error
+    return subject, stages_computed, None
+
+
+def get_subjects(path_data):
+    """Return the subjects of the dataset: folders which contain an 'anat' folder"""
+    return sorted(os.path.basename(os.path.dirname(path_anat))
+                  for path_anat in glob.glob(os.path.join(path_data, '*', 'anat'))
+                  if os.path.basename(os.path.dirname(path_anat)) != 'derivatives')
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    path_data = os.path.abspath(args.path_data)
+    path_output = os.path.abspath(args.path_output)
+    path_cache = os.path.abspath(args.path_cache or os.path.join(path_output, 'cache'))
+    subjects = args.subjects or get_subjects(path_data)
+    os.makedirs(path_cache, exist_ok=True)
+
+    process = partial(process_subject, path_data=path_data, path_output=path_output, path_cache=path_cache)
+    jobs = utils.get_jobs(args.jobs)
+    failed = []
+    with ProcessPoolExecutor(max_workers=jobs) if jobs != 1 else nullcontext() as executor:
+        for subject, stages_computed, error in (map if executor is None else executor.map)(process, subjects):
+            if error is not None:
+                print(f"{subject}: failed, see {os.path.join(path_output, 'log', subject + '.log')}")
+                failed.append(subject)
+            else:
+                computed = ', '.join(stages_computed) if stages_computed else 'nothing (all cached)'
+                print(f"{subject}: computed {computed}")
+    try:
+        compute_cnr_batch.merge_results_shards(os.path.join(path_output, 'results', 'results.csv'))
+    except FileNotFoundError:
+        # No subject has results, e.g. SCT is not installed
+        print("No results to merge: no subject was processed successfully.")
+        sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
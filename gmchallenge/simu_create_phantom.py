@@ -4,11 +4,13 @@
 #
 # USAGE:
 # The script should be launched using SCT's python:
-#   python simu_create_phantom.py [-o output_folder]
+#   python simu_create_phantom.py [-o output_folder] [--seed SEED] [--jobs JOBS]
 #
-# Ranges of GM and noise STD can be changed inside the code. They are hard-coded so that a specific version of the code
-# can be tagged, and will always produce the same results (whereas if we allow users to enter params, the output will
-# depends on the input params).
+# Ranges of GM and noise STD can be changed inside the code (see "default params" below). They are hard-coded so that
+# a specific version of the code can be tagged, and will always produce the same results (whereas if we allow users to
+# enter params, the output will depends on the input params). Noise is drawn from a master seed (written in the
+# metadata of each phantom), so that running the script with the same seed gives the same phantoms, whatever the number
+# of jobs.
 #
 # OUTPUT:
 # The script generates a collection of files under specified folder.
@@ -18,11 +20,29 @@
 
 import os
 import argparse
+import json
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import numpy as np
-import nibabel as nib
-import scipy.ndimage as ndimage
-import pandas as pd
-import tqdm
+
+from gmchallenge import compute_cnr, utils
+from gmchallenge.utils import VolumeCache
+
+
+# default params
+WM_VALUE = 100
+GM_VALUES = [120, 140, 160, 180]
+STD_NOISES = [1, 5, 10]
+SMOOTHING = [0, 0.5, 1]  # standard deviation values for Gaussian kernel
+THR_MASK = 0.9  # Set threshold for masks
+# Bounding box of the phantom within the PAM50 template, around the spinal cord
+CROP_BOX = (slice(53, 89), slice(58, 82), slice(845, 855))
+# Radius of the Gaussian kernel, in number of standard deviations (default of scipy.ndimage.gaussian_filter)
+TRUNCATE = 4.0
+# Manifest of the phantoms saved as a single stack (see write_phantom_stack())
+MANIFEST = 'manifest.json'
 
 
 def get_parser():
@@ -33,87 +53,310 @@ def get_parser():
         '-o',
         help='Name of the output folder',
         default='phantom')
+    parser.add_argument(
+        '--seed',
+        help='Master seed of the noise. If not provided, a random seed is used. In both cases, the seed is written in '
+             'the metadata of each phantom. Use a different seed for each set of phantoms (e.g. scan and rescan).',
+        type=int)
+    parser.add_argument(
+        '--jobs',
+        help='Number of parallel processes. Set to -1 to use all the available CPU cores. Default=1.',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--stack',
+        help='Save all phantoms in a single 4d NIfTI file (phantoms.nii.gz), with a JSON manifest (manifest.json) that '
+             'maps the parameters of each phantom to its volume, instead of one NIfTI and one CSV file per phantom.',
+        action='store_true')
+    parser.add_argument(
+        '--compression',
+        help='Compression of the NIfTI files. Compressing takes most of the time to write the phantoms: without '
+             '--stack, files are compressed in parallel by the --jobs processes. Default=gzip.',
+        choices=['gzip', 'none'],
+        default='gzip')
     return parser
 
 
-def crop_data(data):
-    """Crop around the spinal cord"""
-    return data[53:89, 58:82, 845:855]
+def get_halo_box(shape, halo):
+    """
+    Return the bounding box of the phantom (CROP_BOX), extended by halo voxels on each side (within the image).
+    Args:
+        shape: shape of the template
+        halo: number of voxels
+    Returns:
+        box: tuple of slices, in the template
+        box_crop: tuple of slices of CROP_BOX, within box
+    """
+    box = tuple(slice(max(crop.start - halo, 0), min(crop.stop + halo, n)) for crop, n in zip(CROP_BOX, shape))
+    box_crop = tuple(slice(crop.start - halo.start, crop.stop - halo.start) for crop, halo in zip(CROP_BOX, box))
+    return box, box_crop
 
 
-def main(argv=None):
-    # default params
-    wm_value = 100
-    gm_values = [120, 140, 160, 180]
-    std_noises = [1, 5, 10]
-    smoothing = [0, 0.5, 1]  # standard deviation values for Gaussian kernel
-    thr_mask = 0.9  # Set threshold for masks
+def load_atlas():
+    """
+    Read the WM and GM atlases of the PAM50 template (from the SCT installation pointed by the environment variable
+    SCT_DIR) around the phantom, with a halo as wide as the Gaussian kernel of the largest smoothing: the blurred
+    phantom is then identical to blurring the full atlases before cropping.
+    Returns:
+        atlas_wm: WM atlas within the halo box (see get_halo_box())
+        atlas_gm: GM atlas within the halo box
+        box_crop: bounding box of the phantom within the halo box
+        affine: affine of the template
+    """
+    import nibabel as nib
+
+    path_sct = os.getenv('SCT_DIR')
+    folder_template = os.path.join(path_sct, 'data', 'PAM50', 'template')
+    nii_atlas_wm = nib.load(os.path.join(folder_template, 'PAM50_wm.nii.gz'))
+    nii_atlas_gm = nib.load(os.path.join(folder_template, 'PAM50_gm.nii.gz'))
+    halo = int(TRUNCATE * max(SMOOTHING) + 0.5)
+    box, box_crop = get_halo_box(nii_atlas_wm.shape, halo)
+    return nii_atlas_wm.slicer[box].get_fdata(), nii_atlas_gm.slicer[box].get_fdata(), box_crop, nii_atlas_wm.affine
+
+
+def get_grid():
+    """
+    Return the grid of parameters, as a list of tuples (wm_value, gm_value, std_noise, smooth). The order of the grid
+    defines the child of the master seed used by each grid point.
+    """
+    return [(WM_VALUE, gm_value, std_noise, smooth)
+            for gm_value in GM_VALUES for std_noise in STD_NOISES for smooth in SMOOTHING]
+
+
+def get_mask(atlas, box_crop):
+    """Return the mask of the phantom: atlas cropped to the phantom, where values below THR_MASK are set to 0"""
+    data = atlas[box_crop].copy()
+    data[np.where(data < THR_MASK)] = 0
+    return data
+
+
+class PhantomGenerator:
+    """
+    Generate phantoms as a small DAG of stages: atlas -> intensity (WM and GM values) -> smoothing -> noise. The output
+    of the intensity and smoothing stages is memoized, so that it is computed once and reused by all the downstream
+    combinations of parameters (e.g. the blur runs once per GM value and smoothing, whatever the number of noise
+    levels). Memoized stages are kept in a VolumeCache, capped to max_bytes.
+    """
+    def __init__(self, atlas_wm, atlas_gm, box_crop, max_bytes):
+        """
+        Args:
+            atlas_wm: WM atlas within the halo box (see get_halo_box())
+            atlas_gm: GM atlas within the halo box
+            box_crop: bounding box of the phantom within the halo box
+            max_bytes: memory cap of the memoized stages
+        """
+        self.atlas_wm = atlas_wm
+        self.atlas_gm = atlas_gm
+        self.box_crop = box_crop
+        self.cache = VolumeCache(max_bytes)
+
+    def get_intensity(self, wm_value, gm_value):
+        """Return the phantom within the halo box, before smoothing"""
+        key = ('intensity', wm_value, gm_value)
+        data = self.cache.get(key)
+        if data is None:
+            # Add values to each tract and sum across labels
+            data = self.atlas_wm * wm_value + self.atlas_gm * gm_value
+            self.cache.put(key, data)
+        return data
+
+    def get_smoothed(self, wm_value, gm_value, smooth):
+        """Return the cropped phantom, after smoothing and before noise"""
+        import scipy.ndimage as ndimage
+
+        key = ('smoothed', wm_value, gm_value, smooth)
+        data = self.cache.get(key)
+        if data is None:
+            data = self.get_intensity(wm_value, gm_value)
+            # Add blurring
+            if smooth:
+                data = ndimage.gaussian_filter(data, sigma=(smooth), order=0, truncate=TRUNCATE)
+            # Crop (the halo is only needed for blurring)
+            data = data[self.box_crop].copy()
+            self.cache.put(key, data)
+        return data
 
+    def get_phantom(self, wm_value, gm_value, std_noise, smooth, seed_sequence):
+        """Return the cropped phantom, with noise drawn from seed_sequence"""
+        data = self.get_smoothed(wm_value, gm_value, smooth)
+        # add noise
+        if std_noise:
+            rng = np.random.default_rng(seed_sequence)
+            data = data + rng.normal(loc=0, scale=std_noise, size=data.shape)
+        return data
+
+
+# Generator of the current process, see init_generator()
+phantom_generator = None
+
+
+def init_generator(*args):
+    """
+    Create the PhantomGenerator of the current process, so that its memoized stages are shared by all the phantoms
+    generated by this process. args are passed to PhantomGenerator().
+    """
+    global phantom_generator
+    phantom_generator = PhantomGenerator(*args)
+
+
+def compute_phantoms(params):
+    """
+    Compute the phantoms of all noise levels for one GM value and smoothing.
+    Args:
+        params: tuple (wm_value, gm_value, smooth, noises), where noises is a list of tuples (std_noise,
+                seed_sequence). Noise is drawn from seed_sequence, which is spawned from the master seed, so that each
+                phantom only depends on its own parameters.
+    Returns:
+        list of tuples (metadata, data), where metadata is a dict with the parameters, name and seed of the phantom
+    """
+    wm_value, gm_value, smooth, noises = params
+    phantoms = []
+    for std_noise, seed_sequence in noises:
+        data_phantom = phantom_generator.get_phantom(wm_value, gm_value, std_noise, smooth, seed_sequence)
+        # The noise of this phantom can be reproduced with:
+        # np.random.default_rng(np.random.SeedSequence(Seed, spawn_key=(SeedIndex,)))
+        metadata = {'WM': wm_value,
+                    'GM': gm_value,
+                    'Noise': std_noise,
+                    'Smooth': smooth,
+                    'Name': "phantom_WM" + str(wm_value) + "_GM" + str(gm_value) + "_Noise" + str(std_noise) +
+                            "_Smooth" + str(smooth),
+                    'Seed': seed_sequence.entropy,
+                    'SeedIndex': seed_sequence.spawn_key[0]}
+        phantoms.append((metadata, data_phantom))
+    return phantoms
+
+
+def generate_phantoms(params, affine, folder_out, ext='.nii.gz'):
+    """
+    Compute the phantoms of all noise levels for one GM value and smoothing (see compute_phantoms()), and save each of
+    them in its own NIfTI file, along with its metadata in a CSV file.
+    Args:
+        params: see compute_phantoms()
+        affine: affine of the output images
+        folder_out: output folder
+        ext: extension of the NIfTI files ('.nii.gz' or '.nii')
+    Returns:
+        list of the metadata of each phantom
+    """
+    import nibabel as nib
+    import pandas as pd
+
+    phantoms = compute_phantoms(params)
+    for metadata, data_phantom in phantoms:
+        file_out = metadata['Name']
+        # save as NIfTI file
+        nii_phantom = nib.Nifti1Image(data_phantom, affine)
+        nib.save(nii_phantom, os.path.join(folder_out, file_out + ext))
+        # save metadata
+        metadata = pd.Series({'WM': metadata['WM'],
+                              'GM': metadata['GM'],
+                              'Noise': metadata['Noise'],
+                              'Smooth': metadata['Smooth'],
+                              'File': file_out + ext,
+                              'Seed': metadata['Seed'],
+                              'SeedIndex': metadata['SeedIndex']})
+        metadata.to_csv(os.path.join(folder_out, file_out + ".csv"))
+    return [metadata for metadata, _ in phantoms]
+
+
+def write_phantom_stack(folder_out, phantoms, affine, ext='.nii.gz'):
+    """
+    Save all phantoms in a single 4d NIfTI file (one volume per phantom), along with a JSON manifest that maps the
+    parameters of each phantom to its volume in the stack. See read_phantom_stack().
+    Args:
+        folder_out: output folder
+        phantoms: list of tuples (metadata, data), see compute_phantoms()
+        affine: affine of the output image
+        ext: extension of the NIfTI file ('.nii.gz' or '.nii')
+    """
+    import nibabel as nib
+
+    fname_stack = 'phantoms' + ext
+    nib.save(nib.Nifti1Image(np.stack([data for _, data in phantoms], axis=-1), affine),
+             os.path.join(folder_out, fname_stack))
+    manifest = {'Stack': fname_stack,
+                'Masks': {'mask_wm': 'mask_wm' + ext, 'mask_gm': 'mask_gm' + ext},
+                'Phantoms': [dict(metadata, Volume=i_volume) for i_volume, (metadata, _) in enumerate(phantoms)]}
+    with open(os.path.join(folder_out, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def read_phantom_stack(folder):
+    """
+    Read the phantoms saved with write_phantom_stack(). The stack is read with a single open (and memory-mapped if it
+    is not compressed).
+    Args:
+        folder: folder of the phantoms
+    Returns:
+        manifest: dict, with the list of the metadata of each phantom in manifest['Phantoms']. The volume of each
+                  phantom in the stack is metadata['Volume'].
+        stack: 4d array
+    """
+    with open(os.path.join(folder, MANIFEST)) as f:
+        manifest = json.load(f)
+    return manifest, compute_cnr.load_data(os.path.join(folder, manifest['Stack']))
+
+
+def main(argv=None):
     # user params
     parser = get_parser()
     args = parser.parse_args(argv)
     folder_out = args.o
 
+    # Imported after parsing arguments, so that --help does not load them
+    import nibabel as nib
+    import tqdm
+
     # create output folder
     if not os.path.exists(folder_out):
         os.makedirs(folder_out)
 
     # Open white and gray matter masks from SCT
-    path_sct = os.getenv('SCT_DIR')
-    folder_template = os.path.join(path_sct, 'data', 'PAM50', 'template')
-    nii_atlas_wm = nib.load(os.path.join(folder_template, 'PAM50_wm.nii.gz'))
-    nii_atlas_gm = nib.load(os.path.join(folder_template, 'PAM50_gm.nii.gz'))
+    atlas_wm, atlas_gm, box_crop, affine = load_atlas()
+
+    # Build the grid of parameters. Each grid point gets its own child of the master seed, so that its noise does not
+    # depend on the order in which phantoms are generated (i.e. on the number of jobs).
+    grid = get_grid()
+    seed_sequences = np.random.SeedSequence(args.seed).spawn(len(grid))
+    # Group grid points by GM value and smoothing, so that each smoothed phantom is computed by a single process
+    tasks = OrderedDict()
+    for (wm_value, gm_value, std_noise, smooth), seed_sequence in zip(grid, seed_sequences):
+        tasks.setdefault((wm_value, gm_value, smooth), []).append((std_noise, seed_sequence))
+    tasks = [key + (noises,) for key, noises in tasks.items()]
 
     print("\nGenerate phantom...")
-    pbar = tqdm.tqdm(total=len(gm_values)*len(std_noises)*len(smoothing))
-    # loop across gm_value and std_values and generate phantom
-    for gm_value in gm_values:
-        for std_noise in std_noises:
-            for smooth in smoothing:
-                nii_atlas_wm.uncache()
-                data_wm = nii_atlas_wm.get_fdata()
-                nii_atlas_gm.uncache()
-                data_gm = nii_atlas_gm.get_fdata()
-                # Add values to each tract
-                data_wm *= wm_value
-                data_gm *= gm_value
-                # sum across labels
-                data_phantom = data_wm + data_gm
-                # Add blurring
-                if smooth:
-                    data_phantom = ndimage.gaussian_filter(data_phantom, sigma=(smooth), order=0)
-                # add noise
-                if std_noise:
-                    data_phantom += np.random.normal(loc=0, scale=std_noise, size=data_phantom.shape)
-                # build file name
-                file_out = "phantom_WM" + str(wm_value) + "_GM" + str(gm_value) + "_Noise" + str(std_noise) + \
-                           "_Smooth" + str(smooth)
-                # save as NIfTI file
-                nii_phantom = nib.Nifti1Image(crop_data(data_phantom), nii_atlas_wm.affine)
-                nib.save(nii_phantom, os.path.join(folder_out, file_out + ".nii.gz"))
-                # save metadata
-                metadata = pd.Series({'WM': wm_value,
-                                      'GM': gm_value,
-                                      'Noise': std_noise,
-                                      'Smooth': smooth,
-                                      'File': file_out + ".nii.gz"})
-                metadata.to_csv(os.path.join(folder_out, file_out + ".csv"))
-                pbar.update(1)
-    pbar.close()
+    ext = '.nii.gz' if args.compression == 'gzip' else '.nii'
+    if args.stack:
+        # Phantoms are sent back to the main process, to be saved in a single file
+        process_task = compute_phantoms
+    else:
+        process_task = partial(generate_phantoms, affine=affine, folder_out=folder_out, ext=ext)
+    phantoms = []
+    # The memoized stages are capped with the same environment variable as the cache of compute_cnr
+    initargs = (atlas_wm, atlas_gm, box_crop, utils.get_cache_bytes())
+    jobs = utils.get_jobs(args.jobs)
+    with tqdm.tqdm(total=len(grid)) as pbar:
+        if jobs == 1:
+            init_generator(*initargs)
+            for output in map(process_task, tasks):
+                phantoms += output
+                pbar.update(len(output))
+        else:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=init_generator, initargs=initargs) as executor:
+                for output in executor.map(process_task, tasks):
+                    phantoms += output
+                    pbar.update(len(output))
+    if args.stack:
+        write_phantom_stack(folder_out, phantoms, affine, ext)
 
     # generate mask of gray matter
-    nii_atlas_gm.uncache()
-    data_gm = nii_atlas_gm.get_fdata()
-    data_gm[np.where(data_gm < thr_mask)] = 0
-    nii_phantom = nib.Nifti1Image(crop_data(data_gm), nii_atlas_wm.affine)
-    nib.save(nii_phantom, os.path.join(folder_out, "mask_gm.nii.gz"))
+    nii_phantom = nib.Nifti1Image(get_mask(atlas_gm, box_crop), affine)
+    nib.save(nii_phantom, os.path.join(folder_out, "mask_gm" + ext))
 
     # generate mask of white matter
-    nii_atlas_wm.uncache()
-    data_wm = nii_atlas_wm.get_fdata()
-    data_wm[np.where(data_wm < thr_mask)] = 0
-    nii_phantom = nib.Nifti1Image(crop_data(data_wm), nii_atlas_wm.affine)
-    nib.save(nii_phantom, os.path.join(folder_out, "mask_wm.nii.gz"))
+    nii_phantom = nib.Nifti1Image(get_mask(atlas_wm, box_crop), affine)
+    nib.save(nii_phantom, os.path.join(folder_out, "mask_wm" + ext))
 
     # display
     print("Done!")
@@ -3,10 +3,10 @@
 # Make figures to assess metrics sensitivity to image quality. Run after simu_process_data.py
 #
 # USAGE:
-#   python simu_make_figures.py -i simu_results/results_all.csv
+#   python simu_make_figures.py -i simu_results/results_all.csv [-s 0 1] [--jobs -1]
 #
 # OUTPUT:
-# Figs
+# Figs and CSV tables, for each metric and each smoothing factor
 #
 # Authors: Julien Cohen-Adad
 
@@ -14,10 +14,16 @@
 import os
 import csv
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mticker
+
+from gmchallenge import utils
+from gmchallenge.simu_process_data import METRICS
+
+
+# Colors of the bars, from the lowest to the highest noise level, when there are no more levels than colors
+COLORS = ['r', 'y', 'b']
 
 
 def get_parser():
@@ -27,69 +33,123 @@ def get_parser():
                         help="CSV file generated by simu_process_data.py.",
                         required=True)
     parser.add_argument("-s", "--smooth",
-                        help="Smoothing factor. Default=0.",
+                        help="Smoothing factors to make figures for. Default: all smoothing factors of the input file.",
                         type=float,
-                        default=0,
+                        nargs='+',
                         required=False)
+    parser.add_argument("--jobs",
+                        help="Number of parallel processes to render figures. Set to -1 to use all the available CPU "
+                             "cores. Default=1.",
+                        type=int,
+                        default=1)
     return parser
 
 
+def aggregate(results_all, smooths=None):
+    """
+    Arrange the results as one GM x Noise table per smoothing factor and metric, in a single groupby pass.
+    Args:
+        results_all: DataFrame generated by simu_process_data.py
+        smooths: list of smoothing factors to keep. If None, all smoothing factors are kept.
+    Returns:
+        list of tuples (metric, smooth, table), where table is a DataFrame indexed by GM, with one column per noise
+        level
+    """
+    metrics = [metric for metric in METRICS if metric in results_all]
+    if smooths is not None:
+        results_all = results_all[results_all['Smooth'].isin(smooths)]
+    means = results_all.groupby(['Smooth', 'GM', 'Noise'])[metrics].mean()
+    tables = []
+    for smooth, means_smooth in means.groupby(level='Smooth'):
+        means_smooth = means_smooth.droplevel('Smooth')
+        for metric in metrics:
+            tables.append((metric, smooth, means_smooth[metric].unstack('Noise').sort_index().sort_index(axis=1)))
+    return tables
+
+
+def write_table(fname_out, table):
+    """Save table as CSV, with one row per noise level, for importing as table"""
+    with open(fname_out, "w") as f:
+        writer = csv.writer(f)
+        for row in table.to_numpy().transpose():
+            row = [f"%.2f" % f for f in row]  # we need to do this otherwise float conversion gives e.g. 23.00000001
+            writer.writerow(row)
+
+
+def render_figure(fname_out, metric, table, wm):
+    """
+    Plot the bars of a GM x Noise table, with one group of bars per GM value and one bar per noise level.
+    Args:
+        fname_out: PNG output file
+        metric: name of the metric
+        table: DataFrame indexed by GM, with one column per noise level, see aggregate()
+        wm: WM value, to express GM values as simulated contrasts
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as mticker
+
+    list_gm = table.index.tolist()
+    data = table.to_numpy()
+    n_noise = data.shape[1]
+    colors = COLORS if n_noise <= len(COLORS) else plt.cm.jet_r(np.linspace(0, 1, n_noise))
+    N = len(list_gm)
+    fig, ax = plt.subplots()
+    ind = np.arange(N)  # the x locations for the groups
+    width = 0.6 / max(n_noise, 3)  # the width of the bars
+    fontsize = 16
+    fontsize_axes = 14
+    linewidth = 1  # linewidth of bar contour
+    # Bars are ordered from the highest noise level (left) to the lowest (right)
+    for i_noise in range(n_noise):
+        ax.bar(ind + ((n_noise - 1) / 2 - i_noise) * width, data[:, i_noise], width, color=colors[i_noise],
+               linewidth=linewidth, edgecolor='k', align='center')
+    ax.set_title(metric, fontsize=fontsize)
+    ax.set_xlabel("Simulated Contrast (in %)", fontsize=fontsize)
+    ax.set_xticks(ind)
+    xticklabels = [int(100 * abs(i_gm-wm) / min(i_gm, wm)) for i_gm in list_gm]
+    ax.set_xticklabels(xticklabels, fontsize=fontsize_axes)
+    ax.set_ylabel("Measured " + metric, fontsize=fontsize)
+    yticklabels = ax.get_yticks().astype(int)
+    ax.yaxis.set_major_locator(mticker.FixedLocator(yticklabels))
+    ax.set_yticklabels(yticklabels, fontsize=fontsize_axes)
+    ax.grid(axis='y', linestyle="dashed")
+    ax.autoscale_view()
+    fig.savefig(fname_out, dpi=300)
+    plt.close(fig)
+
+
 def main(argv=None):
     path_output = 'simu_results/'
     # Get input args
     parser = get_parser()
     args = parser.parse_args(argv)
     file_csv = args.input
-    smooth = args.smooth
+
+    # Imported after parsing arguments, so that --help does not load pandas
+    import pandas as pd
 
     results_all = pd.read_csv(file_csv)
+    wm = results_all['WM'].min()
+    tables = aggregate(results_all, args.smooth)
+
+    os.makedirs(path_output, exist_ok=True)
+    fname_figures, figures = [], []
+    for metric, smooth, table in tables:
+        fname_out = os.path.join(path_output, "results_" + metric + "_smooth" + str(smooth))
+        write_table(fname_out + ".csv", table)
+        fname_figures.append(fname_out + ".png")
+        figures.append((metric, table))
 
-    # build index
-    list_gm = sorted(list(set(results_all['GM'].tolist())))
-    list_noise = sorted(list(set(results_all['Noise'].tolist())))
-    wm = sorted(list(set(results_all['WM'].tolist())))[0]
-
-    for metric in ['Contrast', 'SNR_diff', 'SNR_single']:
-        # build array
-        data = np.zeros([len(list_gm), len(list_noise)])
-        for i_gm in range(len(list_gm)):
-            for i_noise in range(len(list_noise)):
-                data[i_gm, i_noise] = results_all.query("Noise == " + str(list_noise[i_noise]) +
-                                                        " & Smooth == " + str(smooth) +
-                                                        " & GM == " + str(list_gm[i_gm]))[metric]
-        # plot fig
-        N = len(list_gm)
-        fig, ax = plt.subplots()
-        ind = np.arange(N)  # the x locations for the groups
-        width = 0.20  # the width of the bars
-        fontsize = 16
-        fontsize_axes = 14
-        linewidth = 1  # linewidth of bar contour
-        p2 = ax.bar(ind - width, data[:, 2], width, color='b', linewidth=linewidth, edgecolor='k')
-        p1 = ax.bar(ind, data[:, 1], width, color='y', linewidth=linewidth, edgecolor='k', align='center')
-        p3 = ax.bar(ind + width, data[:, 0], width, color='r', linewidth=linewidth, edgecolor='k')
-        ax.set_title(metric, fontsize=fontsize)
-        ax.set_xlabel("Simulated Contrast (in %)", fontsize=fontsize)
-        ax.set_xticks(ind)
-        xticklabels = [int(100 * abs(i_gm-wm) / min(i_gm, wm)) for i_gm in list_gm]
-        ax.set_xticklabels(xticklabels, fontsize=fontsize_axes)
-        # ax.legend((p1[0], p2[0], p3[0]), (["Noise STD = " + str(i) for i in list_noise]))
-        ax.set_ylabel("Measured " + metric, fontsize=fontsize)
-        # ax.set_ylim(0, 80)
-        yticklabels = ax.get_yticks().astype(int)
-        ax.yaxis.set_major_locator(mticker.FixedLocator(yticklabels))
-        ax.set_yticklabels(yticklabels, fontsize=fontsize_axes)
-        plt.grid(axis='y', linestyle="dashed")
-        ax.autoscale_view()
-        # plt.show()
-        plt.savefig(os.path.join(path_output, "results_" + metric + "_smooth" + str(smooth) + ".png"), dpi=300)
-
-        # save csv for importing as table
-        with open(os.path.join(path_output, "results_" + metric + "_smooth" + str(smooth) + ".csv"), "w") as f:
-            writer = csv.writer(f)
-            for row in data.transpose():
-                row = [f"%.2f" % f for f in row]  # we need to do this otherwise float conversion gives e.g. 23.00000001
-                writer.writerow(row)
+    # Figures are independent, so they are rendered in parallel on the non-interactive Agg backend
+    jobs = utils.get_jobs(args.jobs)
+    if jobs == 1:
+        for fname_out, (metric, table) in zip(fname_figures, figures):
+            render_figure(fname_out, metric, table, wm)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(render_figure, fname_figures, *zip(*figures), [wm] * len(figures)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+# Assess the metrics with Monte Carlo simulations, without writing phantoms on disk. For each point of the grid of
+# simu_create_phantom, many noise realizations of a scan and a rescan are drawn in memory, and the metrics are computed
+# with compute_cnr, vectorized across realizations. The distribution of each metric is compared to its ground truth,
+# computed on the noise-free phantom.
+#
+# USAGE:
+# The script should be launched using SCT's python:
+#   python simu_monte_carlo.py [-n 1000] [--seed SEED] [-o simu_results/results_montecarlo.csv]
+#
+# OUTPUT:
+#   CSV file with one row per grid point, and the mean, standard deviation, ground truth and bias (mean - ground truth)
+#   of each metric across realizations.
+
+import os
+import argparse
+
+import numpy as np
+
+from gmchallenge import compute_cnr, utils
+from gmchallenge.simu_create_phantom import PhantomGenerator, get_grid, get_mask, load_atlas
+
+
+METRICS = ['SNR_single', 'SNR_diff', 'Contrast', 'CNR_single', 'CNR_diff']
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Assess the metrics with Monte Carlo simulations: draw many noise '
+                                                 'realizations of the synthetic phantoms in memory, and report the '
+                                                 'distribution of each metric.')
+    parser.add_argument("-n", "--realizations",
+                        help="Number of noise realizations per grid point. Default=1000.",
+                        type=int,
+                        default=1000)
+    parser.add_argument("--seed",
+                        help="Master seed of the noise. If not provided, a random seed is used.",
+                        type=int)
+    parser.add_argument("--chunk-size",
+                        help="Number of realizations drawn at once, to bound memory usage. Default=100.",
+                        type=int,
+                        default=100)
+    parser.add_argument("-o", "--output",
+                        help="CSV output file. Default=simu_results/results_montecarlo.csv.",
+                        default=os.path.join('simu_results', 'results_montecarlo.csv'))
+    return parser
+
+
+def pack_masks(*masks):
+    """
+    Pack the voxels of the union of masks into a compact volume of shape (n, 1, nz), where n is the largest number of
+    voxels in a slice: the voxels of slice z are stored in packed[:, 0, z]. Since the metrics only read the voxels
+    within the masks, and slice by slice, computing them on the packed volume gives the same results while only
+    drawing noise for the voxels that are used.
+    Args:
+        masks: MaskIndex
+    Returns:
+        masks_packed: list of MaskIndex, indexing the packed volume
+        coords: tuple (x, y, z) of the voxels of the union, in the original volume
+        coords_packed: tuple of the coordinates of the same voxels, in the packed volume
+    """
+    shape = masks[0].shape
+    flat_index = np.unique(np.concatenate([mask.flat_index for mask in masks]))
+    x, y, z = np.unravel_index(flat_index, shape)
+    # Rank of each voxel within its slice
+    order = np.argsort(z, kind='stable')
+    count = np.bincount(z, minlength=shape[2])
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.size) - np.repeat(np.cumsum(count) - count, count)
+    shape_packed = (max(int(count.max(initial=0)), 1), 1, shape[2])
+    masks_packed = []
+    for mask in masks:
+        ind = np.searchsorted(flat_index, mask.flat_index)
+        flat_index_packed = np.ravel_multi_index((rank[ind], np.zeros_like(ind), z[ind]), shape_packed)
+        masks_packed.append(compute_cnr.MaskIndex(shape_packed, flat_index_packed, mask.indptr, mask.weights))
+    return masks_packed, (x, y, z), (rank, np.zeros_like(rank), z)
+
+
+def compute_ground_truth(data, mask_noise, mask_wm, mask_gm, std_noise):
+    """
+    Compute the ground truth of each metric, from the noise-free phantom and the standard deviation of the noise.
+    Args:
+        data: noise-free phantom (3d array)
+        mask_noise: mask where to compute noise (MaskIndex)
+        mask_wm: mask of white matter (MaskIndex)
+        mask_gm: mask of gray matter (MaskIndex)
+        std_noise: standard deviation of the noise
+    Returns:
+        dict: {metric: ground truth}
+    """
+    mean_noise_slice, _ = compute_cnr.compute_slice_stats(data, mask_noise)
+    mean_wm_slice, _ = compute_cnr.compute_slice_stats(data, mask_wm)
+    mean_gm_slice, _ = compute_cnr.compute_slice_stats(data, mask_gm)
+    snr = np.mean(mean_noise_slice / std_noise)
+    contrast, cnr, _ = compute_cnr.compute_cnr_time_from_means(mean_wm_slice, mean_gm_slice, std_noise, None)
+    return {'SNR_single': snr, 'SNR_diff': snr, 'Contrast': contrast, 'CNR_single': cnr, 'CNR_diff': cnr}
+
+
+def simulate(data, mask_noise, mask_wm, mask_gm, std_noise, n_realizations, rng, chunk_size=100):
+    """
+    Compute the metrics on noise realizations of a scan and a rescan of the phantom data.
+    Args:
+        data: noise-free phantom (3d array)
+        mask_noise: mask where to compute noise (MaskIndex)
+        mask_wm: mask of white matter (MaskIndex)
+        mask_gm: mask of gray matter (MaskIndex)
+        std_noise: standard deviation of the noise
+        n_realizations: number of realizations
+        rng: np.random.Generator to draw the noise from
+        chunk_size: number of realizations drawn at once
+    Returns:
+        dict: {metric: 1d array of the metric for each realization}
+    """
+    # Only draw noise for the voxels within the masks, since the metrics do not read the other voxels
+    masks, coords, coords_packed = pack_masks(mask_noise, mask_wm, mask_gm)
+    data_packed = np.zeros(masks[0].shape)
+    data_packed[coords_packed] = data[coords]
+    data = data_packed[..., np.newaxis]
+    metrics = {metric: [] for metric in METRICS}
+    for i_start in range(0, n_realizations, chunk_size):
+        # Realizations are stacked along a 4th axis, which compute_cnr handles as independent volumes
+        shape = data.shape[:3] + (min(chunk_size, n_realizations - i_start),)
+        data1 = data + rng.normal(loc=0, scale=std_noise, size=shape)
+        data2 = data + rng.normal(loc=0, scale=std_noise, size=shape)
+        stats = compute_cnr.compute_slice_metrics(data1, *masks, data2=data2)
+        results = compute_cnr.compute_results(stats).to_dict()
+        for metric in METRICS:
+            metrics[metric].append(results[metric])
+    return {metric: np.concatenate(values) for metric, values in metrics.items()}
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    # Imported after parsing arguments, so that --help does not load them
+    import pandas as pd
+    import tqdm
+
+    atlas_wm, atlas_gm, box_crop, _ = load_atlas()
+    # Same masks as simu_process_data: noise is computed in the WM
+    mask_wm = compute_cnr.MaskIndex.from_mask(get_mask(atlas_wm, box_crop))
+    mask_gm = compute_cnr.MaskIndex.from_mask(get_mask(atlas_gm, box_crop))
+    generator = PhantomGenerator(atlas_wm, atlas_gm, box_crop, utils.get_cache_bytes())
+
+    grid = get_grid()
+    seed_sequences = np.random.SeedSequence(args.seed).spawn(len(grid))
+    rows = []
+    for (wm_value, gm_value, std_noise, smooth), seed_sequence in tqdm.tqdm(zip(grid, seed_sequences),
+                                                                            total=len(grid)):
+        data = generator.get_smoothed(wm_value, gm_value, smooth)
+        metrics = simulate(data, mask_wm, mask_wm, mask_gm, std_noise, args.realizations,
+                           np.random.default_rng(seed_sequence), chunk_size=args.chunk_size)
+        truth = compute_ground_truth(data, mask_wm, mask_wm, mask_gm, std_noise)
+        row = {'WM': wm_value, 'GM': gm_value, 'Noise': std_noise, 'Smooth': smooth,
+               'Realizations': args.realizations, 'Seed': seed_sequence.entropy,
+               'SeedIndex': seed_sequence.spawn_key[0]}
+        for metric in METRICS:
+            row[metric + '_mean'] = np.mean(metrics[metric])
+            row[metric + '_std'] = np.std(metrics[metric], ddof=1)
+            row[metric + '_true'] = truth[metric]
+            row[metric + '_bias'] = row[metric + '_mean'] - truth[metric]
+        rows.append(row)
+
+    if os.path.dirname(args.output):
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    pd.DataFrame(rows).to_csv(args.output, index=False)
+    print(f"Results written to: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,15 @@
 #!/usr/bin/env python
 #
 # Process data from two phantom folders pairwise. This script will look for csv files in each phantom folder (generated
-# by simu_create_phantom.py), and will process data pairwise between folder1 and folder2.
+# by simu_create_phantom.py), and will process data pairwise between folder1 and folder2. If the phantoms were saved as
+# a single stack (simu_create_phantom.py --stack), the manifest of each folder is read instead.
 #
 # USAGE:
 #   python simu_process_data.py -i phantom1 phantom2 -s phantom1/mask_cord.nii.gz -g phantom1/mask_gm.nii.gz -r 0
 #
 # OUTPUT:
-#   results_simu.csv: quantitative results in CSV format
+#   results_simu.csv: quantitative results in CSV format. Each row includes a hash of its inputs (phantoms, masks and
+#   version of compute_cnr.py), so that re-running the script only processes new or changed pairs.
 #
 # Authors: Julien Cohen-Adad
 
@@ -16,11 +18,22 @@
 import os
 import argparse
 import glob
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from subprocess import call
-import pandas
-import tqdm
 
-from gmchallenge import compute_cnr
+import numpy as np
+
+from gmchallenge import compute_cnr, utils
+from gmchallenge.simu_create_phantom import MANIFEST, read_phantom_stack
+
+
+# Metrics saved in the output file
+METRICS = ['SNR_single', 'SNR_diff', 'Contrast', 'CNR_single', 'CNR_diff']
+# Parameters of the phantoms, which identify a row of the output file
+PARAMETERS = ['WM', 'GM', 'Noise', 'Smooth']
 
 
 def get_parser():
@@ -32,6 +45,10 @@ def get_parser():
                         help="List here the two folders to process. They should contain the exact same file names.",
                         nargs='+',
                         required=True)
+    parser.add_argument("--jobs",
+                        help="Number of parallel processes. Set to -1 to use all the available CPU cores. Default=1.",
+                        type=int,
+                        default=1)
     return parser
 
 
@@ -40,60 +57,262 @@ def run(cmd):
     call(cmd.split(' '), stdout=open(os.devnull, "w"))
 
 
+def get_phantom_pairs(folder1, folder2):
+    """
+    List the phantoms of folder1, along with the phantom with the same parameters in folder2.
+    Args:
+        folder1: folder generated by simu_create_phantom.py
+        folder2: folder generated by simu_create_phantom.py, with the same parameters
+    Returns:
+        pairs: list of tuples (metadata, data1, data2), where data1 and data2 are file names, or the indices of the
+               volumes in stacks if phantoms were saved as a stack
+        stacks: tuple of 4d arrays (stack1, stack2) if phantoms were saved as a stack, None otherwise
+    """
+    import pandas
+
+    if os.path.isfile(os.path.join(folder1, MANIFEST)):
+        manifest1, stack1 = read_phantom_stack(folder1)
+        manifest2, stack2 = read_phantom_stack(folder2)
+        volumes2 = {metadata['Name']: metadata['Volume'] for metadata in manifest2['Phantoms']}
+        pairs = [(metadata, metadata['Volume'], volumes2[metadata['Name']]) for metadata in manifest1['Phantoms']]
+        return pairs, (stack1, stack2)
+    pairs = []
+    for fname_csv in sorted(glob.glob(os.path.join(folder1, "*.csv"))):
+        # get file name
+        metadata = pandas.read_csv(fname_csv, index_col=0).to_dict()['0']
+        file_data = metadata["File"]
+        # get fname of each nifti file
+        pairs.append((metadata, os.path.join(folder1, file_data), os.path.join(folder2, file_data)))
+    return pairs, None
+
+
+def get_mask_fname(folder, name):
+    """Return the file name of mask name (e.g. 'mask_wm') in folder, which can be compressed or not"""
+    if os.path.isfile(os.path.join(folder, MANIFEST)):
+        with open(os.path.join(folder, MANIFEST)) as f:
+            return os.path.join(folder, json.load(f)['Masks'][name])
+    fname = os.path.join(folder, name + '.nii.gz')
+    return fname if os.path.isfile(fname) else os.path.join(folder, name + '.nii')
+
+
+def hash_array(data):
+    """Return the SHA-256 hash of an array, including its shape and data type"""
+    digest = hashlib.sha256(f"{data.shape}{data.dtype.str}".encode())
+    digest.update(np.ascontiguousarray(data).tobytes())
+    return digest.hexdigest()
+
+
+def hash_pairs(pairs, stacks, fname_masks):
+    """
+    Return a hash of the inputs of each pair of phantoms: both phantoms, the masks and the version of the code that
+    computes the metrics (compute_cnr.py), so that the results of a pair can be reused as long as none of them changes.
+    Args:
+        pairs: see get_phantom_pairs()
+        stacks: see get_phantom_pairs()
+        fname_masks: list of file names of the masks
+    Returns:
+        list of hashes (str), one per pair
+    """
+    digest = hashlib.sha256()
+    for fname in fname_masks + [compute_cnr.__file__]:
+        digest.update(utils.hash_file(fname).encode())
+    hash_common = digest.hexdigest()
+    hashes = []
+    for _, data1, data2 in pairs:
+        if stacks is not None:
+            hash1, hash2 = hash_array(stacks[0][..., data1]), hash_array(stacks[1][..., data2])
+        else:
+            hash1, hash2 = utils.hash_file(data1), utils.hash_file(data2)
+        hashes.append(hashlib.sha256(f"{hash_common}{hash1}{hash2}".encode()).hexdigest())
+    return hashes
+
+
+def read_cached_results(file_output):
+    """
+    Read the results of the pairs processed in previous runs: rows of file_output, and shards under
+    "<file_output>.shards/" written by runs which may have been interrupted.
+    Returns:
+        dict {hash: {metric: value}}
+    """
+    import pandas
+
+    cached = {}
+    if os.path.isfile(file_output):
+        results_all = pandas.read_csv(file_output, index_col=0, float_precision='round_trip')
+        if 'Hash' in results_all:
+            for row in results_all.dropna(subset=['Hash']).to_dict('records'):
+                cached[row['Hash']] = {metric: row[metric] for metric in METRICS}
+    for fname_shard in glob.glob(os.path.join(file_output + '.shards', '*.json')):
+        with open(fname_shard) as f:
+            cached[os.path.splitext(os.path.basename(fname_shard))[0]] = json.load(f)
+    return cached
+
+
+def write_result_shard(file_output, hash_pair, results_pair):
+    """
+    Write the results of one pair in "<file_output>.shards/<hash>.json", so that they are not lost if the run is
+    interrupted.
+    """
+    fname_shard = os.path.join(file_output + '.shards', hash_pair + '.json')
+    with utils.write_atomic(fname_shard) as fname_tmp, open(fname_tmp, 'w') as f:
+        json.dump(results_pair, f)
+
+
+def share_arrays(arrays):
+    """
+    Copy arrays into shared memory, so that worker processes can read them without receiving a copy of them with each
+    task (see attach_arrays()).
+    Args:
+        arrays: dict {name: ndarray}
+    Returns:
+        blocks: list of SharedMemory. The caller must close and unlink them once workers are done.
+        spec: dict {name: (name of the SharedMemory, shape, dtype)}, to pass to attach_arrays()
+    """
+    blocks, spec = [], {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        spec[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, spec
+
+
+def attach_arrays(spec):
+    """
+    Return the arrays shared with share_arrays(), as read-only views of the shared memory.
+    Returns:
+        blocks: list of SharedMemory, which must be kept alive as long as the arrays are used
+        arrays: dict {name: ndarray}
+    """
+    blocks, arrays = [], {}
+    for name, (block_name, shape, dtype) in spec.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        arrays[name].flags.writeable = False
+        blocks.append(block)
+    return blocks, arrays
+
+
+def get_arrays(mask_wm, mask_gm, stacks=None):
+    """Return the arrays used by all pairs: the arrays of each MaskIndex, and the stacks of phantoms if any"""
+    arrays = {}
+    for name, mask in [('mask_wm', mask_wm), ('mask_gm', mask_gm)]:
+        arrays.update({name + '.shape': np.array(mask.shape), name + '.flat_index': mask.flat_index,
+                       name + '.indptr': mask.indptr, name + '.weights': mask.weights})
+    if stacks is not None:
+        arrays['stack1'], arrays['stack2'] = [np.asarray(stack) for stack in stacks]
+    return arrays
+
+
+# Masks and stacks of the current process, see set_shared()
+shared = {}
+# SharedMemory blocks of the current process, see init_worker()
+shared_blocks = []
+
+
+def set_shared(arrays):
+    """Set the masks and stacks used by process_pair() in the current process, from the output of get_arrays()"""
+    shared.clear()
+    for name in ['mask_wm', 'mask_gm']:
+        shared[name] = compute_cnr.MaskIndex(tuple(int(n) for n in arrays[name + '.shape']),
+                                             arrays[name + '.flat_index'], arrays[name + '.indptr'],
+                                             arrays[name + '.weights'])
+    for name in ['stack1', 'stack2']:
+        if name in arrays:
+            shared[name] = arrays[name]
+
+
+def init_worker(spec):
+    """Initializer of the worker processes: attach the arrays shared by the main process (see share_arrays())"""
+    global shared_blocks
+    shared_blocks, arrays = attach_arrays(spec)
+    set_shared(arrays)
+
+
+def process_pair(pair):
+    """
+    Compute the metrics of a pair of phantoms, with the masks set by set_shared().
+    Args:
+        pair: tuple (data1, data2) of file names, or of indices of volumes in the stacks
+    Returns:
+        dict {metric: value}
+    """
+    data1, data2 = [shared[name][..., data] if isinstance(data, int) else data
+                    for name, data in zip(['stack1', 'stack2'], pair)]
+    results = compute_cnr.compute_metrics(data1, shared['mask_wm'], shared['mask_wm'], shared['mask_gm'],
+                                          data2=data2).to_dict()
+    return {metric: results[metric] for metric in METRICS}
+
+
 def main(argv=None):
     parser = get_parser()
     args = parser.parse_args(argv)
+    # Imported after parsing arguments, so that --help does not load them
+    import pandas
+    import tqdm
     path_output = 'simu_results/'
     file_output = os.path.join(path_output, "results_all.csv")
 
-    # Get list of files in folder1
+    # Get list of phantoms in folder1
     folder1, folder2 = args.input
-    fname_csv_list = sorted(glob.glob(os.path.join(folder1, "*.csv")))
-
-    # initialize dataframe
-    results_all = pandas.DataFrame(columns={'WM',
-                                            'GM',
-                                            'Noise',
-                                            'Smooth',
-                                            'SNR_single',
-                                            'SNR_diff',
-                                            'Contrast',
-                                            'CNR_single',
-                                            'CNR_diff'})
-
-    file_wm = os.path.join(folder1, 'mask_wm.nii.gz')
-    file_gm = os.path.join(folder1, 'mask_gm.nii.gz')
+    pairs, stacks = get_phantom_pairs(folder1, folder2)
+    fname_masks = [get_mask_fname(folder1, 'mask_wm'), get_mask_fname(folder1, 'mask_gm')]
+
+    # Only process the pairs whose inputs changed since they were last processed
+    hashes = hash_pairs(pairs, stacks, fname_masks)
+    cached = read_cached_results(file_output)
+    todo = [i for i, hash_pair in enumerate(hashes) if hash_pair not in cached]
+    print(f"{len(pairs) - len(todo)} pairs already processed, {len(todo)} pairs to process")
 
     # loop and process
-    os.makedirs(path_output, exist_ok=True)
-    pbar = tqdm.tqdm(total=len(fname_csv_list))
-    for fname_csv in fname_csv_list:
-        # get file name
-        metadata = pandas.read_csv(fname_csv, index_col=0).to_dict()['0']
-        file_data = metadata["File"]
-        # get fname of each nifti file
-        fname1 = os.path.join(folder1, file_data)
-        fname2 = os.path.join(folder2, file_data)
-        # process pair of data
-        results = compute_cnr.main(['--data1', fname1,
-                                    '--data2', fname2,
-                                    '--mask-noise', file_wm,
-                                    '--mask-wm', file_wm,
-                                    '--mask-gm', file_gm])
-        # append to dataframe
-        results_all = results_all.append({'WM': metadata['WM'],
-                                          'GM': metadata['GM'],
-                                          'Noise': metadata['Noise'],
-                                          'Smooth': metadata['Smooth'],
-                                          'SNR_single': results['SNR_single'],
-                                          'SNR_diff': results['SNR_diff'],
-                                          'Contrast': results['Contrast'],
-                                          'CNR_single': results['CNR_single'],
-                                          'CNR_diff': results['CNR_diff']},
-                                         ignore_index=True)
-        pbar.update(1)
-    pbar.close()
-    results_all.to_csv(file_output)
+    os.makedirs(file_output + '.shards', exist_ok=True)
+    tasks = [pairs[i][1:] for i in todo]
+    if tasks:
+        # Load masks and build their index once, since they are shared by all phantoms
+        mask_wm, mask_gm = [compute_cnr.load_mask_index(fname_mask) for fname_mask in fname_masks]
+        arrays = get_arrays(mask_wm, mask_gm, stacks)
+        jobs = utils.get_jobs(args.jobs)
+        if jobs == 1:
+            set_shared(arrays)
+            for i, results_pair in zip(tqdm.tqdm(todo), map(process_pair, tasks)):
+                write_result_shard(file_output, hashes[i], results_pair)
+                cached[hashes[i]] = results_pair
+        else:
+            # Masks and stacks are sent once to the workers through shared memory, and tasks only contain file names
+            # or volume indices. Tasks are sent by chunks to reduce the overhead of inter-process communication.
+            blocks, spec = share_arrays(arrays)
+            try:
+                with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(spec,)) as executor:
+                    chunksize = max(1, len(tasks) // (4 * jobs))
+                    results = executor.map(process_pair, tasks, chunksize=chunksize)
+                    for i, results_pair in zip(tqdm.tqdm(todo), results):
+                        write_result_shard(file_output, hashes[i], results_pair)
+                        cached[hashes[i]] = results_pair
+            finally:
+                for block in blocks:
+                    block.close()
+                    block.unlink()
+
+    # Collect results by column, and build the dataframe once
+    columns = {key: [metadata[key] for metadata, _, _ in pairs] for key in PARAMETERS}
+    columns.update({metric: [cached[hash_pair][metric] for hash_pair in hashes] for metric in METRICS})
+    columns['Hash'] = hashes
+    results_all = pandas.DataFrame(columns)
+    # Merge into the results of previous runs: rows of phantoms with the same parameters are replaced
+    if os.path.isfile(file_output):
+        results_previous = pandas.read_csv(file_output, index_col=0, float_precision='round_trip')
+        if set(PARAMETERS) <= set(results_previous.columns):
+            keys = set(results_all[PARAMETERS].astype(float).itertuples(index=False, name=None))
+            is_kept = [key not in keys
+                       for key in results_previous[PARAMETERS].astype(float).itertuples(index=False, name=None)]
+            results_all = pandas.concat([results_previous[is_kept], results_all], ignore_index=True)
+    with utils.write_atomic(file_output) as fname_tmp:
+        results_all.to_csv(fname_tmp)
+    # Shards are now redundant with the output file
+    for hash_pair in set(results_all['Hash'].dropna()):
+        fname_shard = os.path.join(file_output + '.shards', hash_pair + '.json')
+        if os.path.isfile(fname_shard):
+            os.remove(fname_shard)
 
 
 if __name__ == "__main__":
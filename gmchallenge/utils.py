@@ -0,0 +1,144 @@
+# General-purpose helpers shared by the scripts of gmchallenge: caches, parallel jobs, atomic writes and profiling.
+#
+# They are kept out of compute_cnr.py on purpose: the hash of compute_cnr.py versions the cached metrics (see
+# simu_process_data.hash_pairs() and pipeline.get_stages()), so it should only change when the metrics change.
+
+import hashlib
+import os
+import resource
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+
+class VolumeCache:
+    """
+    Least-recently-used cache of decoded volumes, keyed by file path, modification time, file size and bounding box.
+    The total size of the cached arrays is capped to max_bytes: the least recently used volumes are evicted first.
+    Cached arrays are read-only, since they are shared by all callers.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._volumes = OrderedDict()
+
+    def get(self, key):
+        """Return the cached volume, or None if it is not cached"""
+        if key not in self._volumes:
+            return None
+        self._volumes.move_to_end(key)
+        return self._volumes[key]
+
+    def put(self, key, data):
+        """Add a volume to the cache, and evict the least recently used volumes if the cache exceeds max_bytes"""
+        # Memory-mapped files do not need to be cached, and volumes larger than the cache are not cached
+        if isinstance(data, np.memmap) or data.nbytes > self.max_bytes:
+            return
+        data.flags.writeable = False
+        if key in self._volumes:
+            self.nbytes -= self._volumes.pop(key).nbytes
+        self._volumes[key] = data
+        self.nbytes += data.nbytes
+        while self.nbytes > self.max_bytes:
+            _, data_evicted = self._volumes.popitem(last=False)
+            self.nbytes -= data_evicted.nbytes
+
+    def clear(self):
+        self._volumes.clear()
+        self.nbytes = 0
+
+
+def get_cache_bytes():
+    """
+    Return the cap of the in-memory caches of volumes, in bytes. It is set in MB with the environment variable
+    GMCHALLENGE_CACHE_MB (default: 1024).
+    """
+    return int(os.getenv('GMCHALLENGE_CACHE_MB', 1024)) * 2 ** 20
+
+
+def hash_file(fname):
+    """Return the SHA-256 hash of the content of a file"""
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_jobs(jobs):
+    """
+    Return the number of parallel jobs: jobs, or the number of available CPU cores if jobs <= 0.
+    """
+    return os.cpu_count() if jobs <= 0 else jobs
+
+
+@contextmanager
+def write_atomic(fname, suffix=''):
+    """
+    Context manager which yields the name of a temporary file to write, and renames it to fname on success (or removes
+    it on error). Readers, including parallel jobs, therefore never see a partially-written file.
+    Args:
+        fname: output file
+        suffix: extension of the temporary file, for writers which add one if it is missing (e.g. '.npz' for np.savez)
+    """
+    fname_tmp = f"{fname}.{os.getpid()}.tmp{suffix}"
+    try:
+        yield fname_tmp
+        os.replace(fname_tmp, fname)
+    except BaseException:
+        if os.path.exists(fname_tmp):
+            os.remove(fname_tmp)
+        raise
+
+
+def get_maxrss_mb():
+    """
+    Return the high-water mark of the resident memory of the current process, in MB.
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 2 ** 20 if sys.platform == 'darwin' else 2 ** 10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+class Profiler:
+    """
+    Record the wall time, CPU time and memory of each stage of the computation. Stages that run several times with the
+    same name (e.g. once per slab) are accumulated. Use with compute_cnr.compute_metrics(..., profiler=Profiler()).
+    The resident memory is only available as a high-water mark of the whole process, so each stage records:
+    - maxrss_increase_mb: how much the stage raised the high-water mark. The stages where it is not null are the ones
+      that drive the peak memory usage; it is null for stages that stay below an earlier peak, whatever they allocate.
+    - maxrss_mb: the high-water mark of the process at the end of the stage, including everything before the stage.
+    """
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        wall_time, cpu_time, maxrss = time.perf_counter(), time.process_time(), get_maxrss_mb()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'calls': 0, 'wall_time': 0., 'cpu_time': 0.,
+                                                  'maxrss_increase_mb': 0., 'maxrss_mb': 0.})
+            stage['calls'] += 1
+            stage['wall_time'] += time.perf_counter() - wall_time
+            stage['cpu_time'] += time.process_time() - cpu_time
+            stage['maxrss_mb'] = get_maxrss_mb()
+            stage['maxrss_increase_mb'] += stage['maxrss_mb'] - maxrss
+
+    def to_dict(self):
+        return {'stages': self.stages,
+                'total': {'wall_time': sum(stage['wall_time'] for stage in self.stages.values()),
+                          'cpu_time': sum(stage['cpu_time'] for stage in self.stages.values()),
+                          'maxrss_increase_mb': sum(stage['maxrss_increase_mb'] for stage in self.stages.values()),
+                          'maxrss_mb': max([stage['maxrss_mb'] for stage in self.stages.values()], default=0.)}}
+
+
+def profile_stage(profiler, name):
+    """
+    Return the context manager that records stage name in profiler, or a no-op context manager if profiler is None.
+    """
+    return nullcontext() if profiler is None else profiler.stage(name)
@@ -137,8 +137,10 @@ else
   # define a variable just so the syntax below will not crash. The empty variable will be dealt with by compute_cnr.py.
   file_2=""
 fi
-# Compute SNR and CNR
-compute_cnr \
+# Compute SNR and CNR. If a server was started with "compute_cnr --serve", the computation is sent to its warm workers,
+# otherwise it runs locally. Results are written in "${PATH_RESULTS}/results.csv.shards/${SUBJECT}.csv": once all
+# subjects are processed, merge them into results.csv with "compute_cnr --merge --output ${PATH_RESULTS}/results.csv".
+compute_cnr_client \
   --data1 ${file_1}${ext} \
   --data2 ${file_2}${ext} \
   --mask-noise ${file_1_wmseg}_erode.nii.gz \
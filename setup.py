@@ -39,10 +39,13 @@ setup(
     python_requires="==3.8.*",
     entry_points=dict(
         console_scripts=[
+            'gmchallenge=gmchallenge.pipeline:main',
             'compute_cnr=gmchallenge.compute_cnr:main',
+            'compute_cnr_client=gmchallenge.compute_cnr_client:main',
             'simu_create_phantom=gmchallenge.simu_create_phantom:main',
             'simu_process_data=gmchallenge.simu_process_data:main',
             'simu_make_figures=gmchallenge.simu_make_figures:main',
+            'simu_monte_carlo=gmchallenge.simu_monte_carlo:main',
             'generate_figure_spinegeneric=gmchallenge.generate_figure_spinegeneric:main'],
     ),
 )